@@ -3,13 +3,29 @@ Nasha Smart CSV Transformer - AI-Powered
 Uses Claude AI to intelligently map and transform product data
 """
 
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, Response, g, request, jsonify, send_file, render_template_string, stream_with_context
 import anthropic
+import contextvars
 import csv
+import hashlib
+import httpx
 import io
 import json
+import logging
 import os
+import random
 import re
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from itertools import chain, count
 
 app = Flask(__name__)
 
@@ -76,6 +92,243 @@ PLATFORM_MAPPINGS = {
     }
 }
 
+# Exact platform column structures
+PLATFORM_COLUMNS = {
+    'weedmaps': [
+        'name', 'categories', 'description', 'avatar_image', 'product_id',
+        'external_id', 'sku', 'gallery_images', 'featured', 'tags',
+        'thc_percentage', 'thc_milligrams', 'cbd_percentage', 'cbd_milligrams',
+        'genetics', 'strain', 'items_per_pack', 'msrp', 'weight'
+    ],
+    'leafly': [
+        'Leafly Product ID', 'Name', 'SKU', 'Description', 'Category',
+        'Subcategory', 'Strain', 'THC Content', 'THC Unit', 'CBD Content',
+        'CBD Unit', 'Country Availability', 'State/Province Availability',
+        'External Link URL', 'Image One URL', 'Image Two URL',
+        'Image Three URL', 'Image Four URL', 'Image Five URL'
+    ],
+    'iheartjane': [
+        ' ', 'Strain', 'Brand Category',
+        'Does this Product Come in Standard Pack Sizes of 0.5g (500mg) or 1g (1000mg)?',
+        'Pack Size Next Steps', 'Enter Non-Standard Pack Size Here [g]',
+        'Lineage', 'Product Name (Internal Use)', 'Product Description',
+        'IMAGE LINK ONLY (PLEASE ATTACH IMAGES TO EMAIL IF YOU DON\'T HAVE A LINK)',
+        'Jane Use: Click here when product is added', '', ''
+    ],
+    'squarespace': [
+        'Product ID [Non Editable]', 'Variant ID [Non Editable]',
+        'Product Type [Non Editable]', 'Product Page', 'Product URL',
+        'Title', 'Description', 'SKU', 'Option Name 1', 'Option Value 1',
+        'Option Name 2', 'Option Value 2', 'Option Name 3', 'Option Value 3',
+        'Option Name 4', 'Option Value 4', 'Option Name 5', 'Option Value 5',
+        'Option Name 6', 'Option Value 6', 'Price', 'Sale Price', 'On Sale',
+        'Stock', 'Categories', 'Tags', 'Weight', 'Length', 'Width',
+        'Height', 'Visible', 'Hosted Image URLs'
+    ]
+}
+
+# Platform rows are kept as value lists in PLATFORM_COLUMNS order; this maps each
+# platform's column names to their position in those lists
+PLATFORM_COLUMN_INDEX = {
+    platform: {column: i for i, column in enumerate(columns)} for platform, columns in PLATFORM_COLUMNS.items()
+}
+
+# Columns whose value PLATFORM_FIELD_INSTRUCTIONS fixes; model output is checked
+# against PLATFORM_COLUMNS and these are set rather than trusted
+PLATFORM_FIXED_VALUES = {
+    'weedmaps': {
+        'product_id': '', 'sku': '', 'featured': 'FALSE', 'thc_milligrams': '',
+        'cbd_percentage': '', 'cbd_milligrams': '', 'msrp': '',
+    },
+    'leafly': {
+        'Leafly Product ID': '', 'THC Content': '', 'THC Unit': '', 'CBD Content': '', 'CBD Unit': '',
+        'Country Availability': 'US', 'State/Province Availability': 'CA', 'External Link URL': '',
+        'Image Two URL': '', 'Image Three URL': '', 'Image Four URL': '', 'Image Five URL': '',
+    },
+    'iheartjane': {' ': 'Nasha', '': ''},
+    'squarespace': {
+        'Product ID [Non Editable]': '', 'Variant ID [Non Editable]': '',
+        'Product Type [Non Editable]': 'PHYSICAL', 'Price': '0.00', 'Sale Price': '0.00',
+        'On Sale': 'No', 'Stock': 'Unlimited', 'Weight': '0.0', 'Length': '0.0',
+        'Width': '0.0', 'Height': '0.0', 'Visible': 'Yes',
+    },
+}
+
+# Main category labels, keyed by the PLATFORM_MAPPINGS category keys
+CATEGORY_LABELS = {
+    'hash': 'Hash',
+    'rosin': 'Rosin',
+    'flower': 'Flower',
+    'vape-aio': 'Vape',
+    'vape-510': 'Vape',
+    'preroll-infused': 'Preroll',
+    'preroll-regular': 'Preroll',
+}
+
+# Description lines the rule engine understands, mapped to product record fields
+DESCRIPTION_LABELS = {
+    'THC': 'thc',
+    'LINEAGE': 'lineage',
+    'TASTE': 'taste',
+    'FEELING': 'feeling',
+    'FARM': 'farm',
+    'PLACE GROWN': 'place',
+}
+
+# Fields of the intermediate product record every platform row is rendered from
+RECORD_FIELDS = [
+    'name', 'strain', 'genetics', 'category', 'subcategory', 'weight', 'thc', 'lineage',
+    'taste', 'feeling', 'farm', 'place', 'marketing', 'photo', 'batch', 'sku'
+]
+
+# Input column name patterns (checked in order) for each field the rule engine reads
+INPUT_COLUMN_PATTERNS = {
+    'name': [r'^(product[ _]?)?name$', r'^(product[ _]?)?title$', r'name'],
+    'description': [r'^(product[ _]?)?description$', r'desc'],
+    'photo': [r'photo', r'image', r'img', r'picture'],
+    'batch': [r'batch'],
+    'sku': [r'sku'],
+    'thc': [r'^thc'],
+    'lineage': [r'lineage'],
+    'taste': [r'taste', r'flavou?r'],
+    'feeling': [r'feeling', r'effect'],
+    'farm': [r'farm'],
+    'place': [r'place', r'grown'],
+}
+
+# Product-type words stripped from names to leave the clean strain name (longest first)
+STRAIN_NOISE = sorted([
+    'green unpressed hash', 'orange unpressed hash', 'red pressed hash', 'blue pressed hash',
+    'onyx live pressed hash', 'cold cure live rosin', 'live rosin', 'all-in-one', 'all in one',
+    'aio', 'vape cart', 'vape', 'cartridge', 'cart', '510', 'hash-infused', 'rosin-infused',
+    'infused', 'hash', 'rosin', 'pre-rolls', 'pre-roll', 'pre rolls', 'pre roll', 'prerolls',
+    'preroll', 'multipack', 'flower', 'disposable', 'altitude', 'submerge',
+], key=len, reverse=True)
+
+# Product lines named before the strain ("Altitude Blue Dream Infused Hash Preroll")
+PRODUCT_LINE_PREFIXES = ['altitude', 'submerge']
+
+# Words in a product name pointing at each product form. Concentrate words go
+# with a preroll or vape form (infused prerolls, rosin carts); any other pair
+# of forms is a conflict the rule engine leaves to the model
+CATEGORY_CUES = {
+    'preroll': r'pre-?rolls?\b|pre rolls?\b|\baltitude\b|\bsubmerge\b|\b5[ -]?pack\b|multi-?pack',
+    'vape': r'all[ -]in[ -]one|\baio\b|disposable|\b510\b|\bcart(ridge)?s?\b|\bvape\b',
+    'flower': r'\bflower\b',
+    'concentrate': r'\bhash\b|\brosin\b',
+}
+
+# Analysis main category for each PRODUCT_TAXONOMY heading
+TAXONOMY_LABELS = {
+    'HASH': 'Hash',
+    'COLD CURE ROSIN': 'Rosin',
+    'PACKAGED FLOWER': 'Flower',
+    'VAPE CARTS': 'Vape',
+    'PREROLLS': 'Preroll',
+    '5-PACK PREROLLS': '5-Pack Preroll',
+    'EDIBLES': 'Edibles',
+}
+
+# Set NASHA_RULE_ENGINE=0 to send every row to the model
+RULE_ENGINE_ENABLED = os.environ.get('NASHA_RULE_ENGINE', '1') != '0'
+# Rows the local classifier labels with less confidence than this go to the model
+CLASSIFIER_MIN_CONFIDENCE = float(os.environ.get('NASHA_CLASSIFIER_MIN_CONFIDENCE', '0.8'))
+
+# Model dispatch settings
+MODEL_NAME = "claude-sonnet-4-20250514"
+# Simple rows go to this faster, cheaper model (empty sends every row to MODEL_NAME);
+# rows whose row_difficulty is above NASHA_FAST_MAX_DIFFICULTY go to MODEL_NAME
+FAST_MODEL = os.environ.get('NASHA_FAST_MODEL', 'claude-3-5-haiku-20241022')
+FAST_MAX_DIFFICULTY = int(os.environ.get('NASHA_FAST_MAX_DIFFICULTY', '1'))
+# Descriptions longer than this count toward a row's difficulty
+LONG_DESCRIPTION_CHARS = 1200
+# USD per million tokens, for the cost metrics
+MODEL_PRICING = {
+    'claude-sonnet-4-20250514': {'input': 3.0, 'output': 15.0, 'cache_creation': 3.75, 'cache_read': 0.30},
+    'claude-3-5-haiku-20241022': {'input': 0.80, 'output': 4.0, 'cache_creation': 1.0, 'cache_read': 0.08},
+}
+# Message Batches API requests are billed at half price
+MESSAGE_BATCH_DISCOUNT = 0.5
+# Set NASHA_METRICS_LOG=1 to log one JSON line of stats per request or job
+METRICS_LOG = os.environ.get('NASHA_METRICS_LOG', '0') == '1'
+if METRICS_LOG:
+    app.logger.setLevel(logging.INFO)
+MAX_IN_FLIGHT = int(os.environ.get('NASHA_MAX_IN_FLIGHT', '4'))
+MAX_RETRIES = int(os.environ.get('NASHA_MAX_RETRIES', '6'))
+BACKOFF_BASE = float(os.environ.get('NASHA_BACKOFF_BASE', '1.0'))
+BACKOFF_MAX = float(os.environ.get('NASHA_BACKOFF_MAX', '60'))
+
+# Shared client connection pool and timeouts (seconds)
+MAX_CONNECTIONS = int(os.environ.get('NASHA_MAX_CONNECTIONS', '20'))
+MAX_KEEPALIVE = int(os.environ.get('NASHA_MAX_KEEPALIVE', '10'))
+KEEPALIVE_EXPIRY = float(os.environ.get('NASHA_KEEPALIVE_EXPIRY', '60'))
+API_TIMEOUT = float(os.environ.get('NASHA_API_TIMEOUT', '600'))
+API_CONNECT_TIMEOUT = float(os.environ.get('NASHA_API_CONNECT_TIMEOUT', '10'))
+
+# Each model call fails its batch after NASHA_CALL_DEADLINE seconds (0 disables).
+# With NASHA_HEDGE_PERCENTILE set (e.g. 0.95), a call running longer than that
+# share of recent calls gets a duplicate, and whichever finishes first is used
+CALL_DEADLINE = float(os.environ.get('NASHA_CALL_DEADLINE', '240'))
+HEDGE_PERCENTILE = float(os.environ.get('NASHA_HEDGE_PERCENTILE', '0'))
+HEDGE_MIN_SAMPLES = 20
+# Synchronous requests stop waiting for batches after this many seconds (0 disables),
+# returning what finished and the missing rows before gunicorn's --timeout 600
+REQUEST_DEADLINE = float(os.environ.get('NASHA_REQUEST_DEADLINE', '540'))
+
+# 429 = rate limited, 529 = API overloaded; both pause every in-flight worker
+THROTTLE_STATUS = {429, 529}
+RETRYABLE_STATUS = THROTTLE_STATUS | {408, 409, 500, 502, 503, 504}
+
+# Background jobs; set NASHA_JOB_DB to persist job state across restarts
+JOB_DIR = os.environ.get('NASHA_JOB_DIR', 'nasha_jobs')
+JOB_DB_PATH = os.environ.get('NASHA_JOB_DB', '')
+JOB_WORKERS = int(os.environ.get('NASHA_JOB_WORKERS', '2'))
+JOB_TTL_HOURS = float(os.environ.get('NASHA_JOB_TTL_HOURS', '24'))
+# A process holds a lease on the jobs it runs, renewed every third of this;
+# only jobs whose lease has run out are resumed by another process
+JOB_LEASE_SECONDS = float(os.environ.get('NASHA_JOB_LEASE_SECONDS', '120'))
+# Seconds between status checks of a submitted Message Batch
+MESSAGE_BATCH_POLL_SECONDS = float(os.environ.get('NASHA_MESSAGE_BATCH_POLL_SECONDS', '60'))
+
+# Shared span queue; with NASHA_QUEUE_DB set, spans are queued in SQLite and
+# run by span workers in every process using it (gunicorn workers, `app.py worker`)
+QUEUE_PATH = os.environ.get('NASHA_QUEUE_DB', '')
+QUEUE_WORKERS = int(os.environ.get('NASHA_QUEUE_WORKERS', '4'))
+QUEUE_WINDOW = int(os.environ.get('NASHA_QUEUE_WINDOW', '16'))
+# A span claimed longer ago than this is handed out again, e.g. after its process died
+QUEUE_LEASE_SECONDS = float(os.environ.get('NASHA_QUEUE_LEASE_SECONDS', '900'))
+QUEUE_POLL_SECONDS = 0.2
+
+# Batches are packed with cache misses until their estimated input tokens
+# reach NASHA_BATCH_INPUT_TOKENS or their estimated output would fill more
+# than NASHA_BATCH_OUTPUT_FILL of the call's max_tokens
+BATCH_INPUT_TOKENS = int(os.environ.get('NASHA_BATCH_INPUT_TOKENS', '12000'))
+BATCH_OUTPUT_FILL = float(os.environ.get('NASHA_BATCH_OUTPUT_FILL', '0.6'))
+BATCH_MAX_ROWS = int(os.environ.get('NASHA_BATCH_MAX_ROWS', '50'))
+# Rough characters per token for estimating prompt and completion sizes
+CHARS_PER_TOKEN = 3.5
+
+# max_tokens for each kind of request
+ANALYSIS_MAX_TOKENS = 5000
+TRANSFORM_MAX_TOKENS = 8000
+EXTRACTION_MAX_TOKENS = 8000
+
+# Per-row result cache; set NASHA_CACHE_PATH to an empty string to disable
+CACHE_PATH = os.environ.get('NASHA_CACHE_PATH', 'nasha_cache.sqlite3')
+CACHE_MAX_ROWS = int(os.environ.get('NASHA_CACHE_MAX_ROWS', '200000'))
+CACHE_MAX_AGE_DAYS = float(os.environ.get('NASHA_CACHE_MAX_AGE_DAYS', '30'))
+# Bump to invalidate cached results when output handling changes
+CACHE_VERSION = 1
+# Longest run of rows (hits included) gathered around one batch of misses
+CACHE_SPAN_MAX = 200
+
+# Per-upload transform checkpoints; stored alongside the cache unless set
+CHECKPOINT_PATH = os.environ.get('NASHA_CHECKPOINT_PATH', CACHE_PATH)
+CHECKPOINT_MAX_AGE_HOURS = float(os.environ.get('NASHA_CHECKPOINT_MAX_AGE_HOURS', '48'))
+
+# Last upload of each catalog, per platform, that delta transforms diff against
+CATALOG_PATH = os.environ.get('NASHA_CATALOG_PATH', CACHE_PATH)
+
 # HTML Template (same as before)
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -214,6 +467,7 @@ HTML_TEMPLATE = """
         .btn-iheartjane { background: #ff6b6b; }
         .btn-leafly { background: #72b01d; }
         .btn-squarespace { background: #000000; }
+        .btn-all { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); grid-column: 1 / -1; }
         
         .status-message {
             margin-top: 20px;
@@ -336,6 +590,9 @@ HTML_TEMPLATE = """
                 <button class="download-btn btn-squarespace" id="btnSquarespace" disabled>
                     <span>⬛</span> Squarespace
                 </button>
+                <button class="download-btn btn-all" id="btnAll" disabled>
+                    <span>📦</span> All Platforms (zip)
+                </button>
             </div>
             
             <div class="status-message" id="statusMessage"></div>
@@ -407,6 +664,7 @@ HTML_TEMPLATE = """
                 document.getElementById('btnIHeartJane').disabled = false;
                 document.getElementById('btnLeafly').disabled = false;
                 document.getElementById('btnSquarespace').disabled = false;
+                document.getElementById('btnAll').disabled = false;
                 
                 showStatus('AI analysis complete! Ready to download.', 'success');
             } catch (error) {
@@ -416,11 +674,14 @@ HTML_TEMPLATE = """
             }
         }
         
+        let statusTimer = null;
+        
         function showStatus(message, type) {
             statusMessage.textContent = message;
             statusMessage.className = `status-message ${type}`;
             statusMessage.style.display = 'block';
-            setTimeout(() => {
+            clearTimeout(statusTimer);
+            statusTimer = setTimeout(() => {
                 statusMessage.style.display = 'none';
             }, 5000);
         }
@@ -430,20 +691,78 @@ HTML_TEMPLATE = """
         document.getElementById('btnIHeartJane').addEventListener('click', () => downloadPlatform('iheartjane'));
         document.getElementById('btnLeafly').addEventListener('click', () => downloadPlatform('leafly'));
         document.getElementById('btnSquarespace').addEventListener('click', () => downloadPlatform('squarespace'));
+        document.getElementById('btnAll').addEventListener('click', downloadAll);
         
         async function downloadPlatform(platform) {
             const formData = new FormData();
             formData.append('file', fileInput.files[0]);
             formData.append('platform', platform);
+            formData.append('async', '1');
             
             showStatus('Generating ' + platform + ' CSV...', 'info');
             
             try {
+                // Submit a background job, then poll it instead of holding the connection open
                 const response = await fetch('/transform', {
                     method: 'POST',
                     body: formData
                 });
                 
+                const job = await response.json();
+                if (!response.ok) {
+                    throw new Error(job.error || 'Download failed');
+                }
+                
+                const finished = await pollJob(job.status_url, platform);
+                
+                const a = document.createElement('a');
+                a.href = job.download_url;
+                a.download = `Nasha_${platform}.csv`;
+                a.click();
+                
+                const failed = (finished.result && finished.result.failed_batches) || [];
+                if (failed.length) {
+                    const rows = failed.map(f => `${f.first_row}-${f.last_row}`).join(', ');
+                    showStatus(`Downloaded ${platform} CSV, but rows ${rows} failed. Download again to retry just those rows.`, 'error');
+                } else {
+                    showStatus(`Downloaded ${platform} CSV!`, 'success');
+                }
+            } catch (error) {
+                showStatus('Download error: ' + error.message, 'error');
+            }
+        }
+        
+        async function pollJob(statusUrl, platform) {
+            while (true) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
+                
+                const response = await fetch(statusUrl);
+                const job = await response.json();
+                if (!response.ok) {
+                    throw new Error(job.error || 'Job lookup failed');
+                }
+                
+                if (job.status === 'done') return job;
+                if (job.status === 'failed') throw new Error(job.error || 'Job failed');
+                
+                if (job.batches_total) {
+                    showStatus(`Generating ${platform} CSV... ${job.batches_done}/${job.batches_total} batches`, 'info');
+                }
+            }
+        }
+        
+        async function downloadAll() {
+            const formData = new FormData();
+            formData.append('file', fileInput.files[0]);
+            
+            showStatus('Generating CSVs for all platforms...', 'info');
+            
+            try {
+                const response = await fetch('/export', {
+                    method: 'POST',
+                    body: formData
+                });
+                
                 if (!response.ok) {
                     const error = await response.json();
                     throw new Error(error.error || 'Download failed');
@@ -453,11 +772,11 @@ HTML_TEMPLATE = """
                 const url = window.URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.href = url;
-                a.download = `Nasha_${platform}.csv`;
+                a.download = 'Nasha_all_platforms.zip';
                 a.click();
                 window.URL.revokeObjectURL(url);
                 
-                showStatus(`Downloaded ${platform} CSV!`, 'success');
+                showStatus('Downloaded all platform CSVs!', 'success');
             } catch (error) {
                 showStatus('Download error: ' + error.message, 'error');
             }
@@ -467,302 +786,3222 @@ HTML_TEMPLATE = """
 </html>
 """
 
-@app.route('/')
-def index():
-    return render_template_string(HTML_TEMPLATE)
+class MetricsRegistry:
+    """Process-wide counters, rendered in the Prometheus text format"""
 
-@app.route('/analyze', methods=['POST'])
-def analyze():
-    """AI analyzes the uploaded CSV and categorizes all products"""
+    HELP = {
+        'nasha_requests_total': 'Requests and jobs finished',
+        'nasha_request_seconds_total': 'Wall-clock seconds spent in requests and jobs',
+        'nasha_stage_seconds_total': 'Seconds spent per pipeline stage, summed across threads',
+        'nasha_rows_total': 'Input rows processed',
+        'nasha_batches_total': 'Batches of rows sent to the model',
+        'nasha_model_calls_total': 'Model calls made',
+        'nasha_retries_total': 'Model calls retried after a rate limit, overload or transient error',
+        'nasha_repaired_rows_total': 'Rows re-requested after their output failed the platform schema',
+        'nasha_hedged_calls_total': 'Duplicate model calls sent for calls running longer than usual',
+        'nasha_escalated_rows_total': 'Rows re-sent to the main model after the fast model failed them',
+        'nasha_tokens_total': 'Model tokens by type',
+        'nasha_cost_usd_total': 'Estimated model cost in USD',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted((k, v) for k, v in labels.items() if v is not None)))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    @staticmethod
+    def escape(value):
+        """A label value as the text format requires, with \\, " and newlines escaped"""
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        for name, help_text in self.HELP.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (metric, labels), value in values:
+                if metric == name:
+                    label_text = ','.join(f'{k}="{self.escape(v)}"' for k, v in labels)
+                    lines.append(f'{name}{{{label_text}}} {value:g}' if labels else f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+class RequestStats:
+    """Stage timings, model calls and token usage for one request or job"""
+
+    COUNTS = [
+        'rows', 'batches', 'calls', 'retries', 'repaired_rows', 'hedged_calls', 'escalated_rows', 'input_tokens', 'output_tokens',
+        'cache_creation_input_tokens', 'cache_read_input_tokens',
+    ]
+
+    def __init__(self, endpoint, platform=None):
+        self.endpoint = endpoint
+        self.platform = platform
+        self.started = time.monotonic()
+        self.counts = dict.fromkeys(self.COUNTS, 0)
+        self.cost = 0.0
+        self.stages = {}
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add(self, cost=0.0, **counts):
+        with self._lock:
+            self.cost += cost
+            for name, value in counts.items():
+                self.counts[name] += value or 0
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, stats):
+        """Add counts and stage times from another RequestStats' as_dict()"""
+        self.add(cost=stats['cost_usd'], **{name: stats[name] for name in self.COUNTS})
+        for name, seconds in stats['stages'].items():
+            self.add_stage(name, seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'endpoint': self.endpoint,
+                'platform': self.platform,
+                'seconds': round(time.monotonic() - self.started, 4),
+                'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                **self.counts,
+                'cost_usd': round(self.cost, 6),
+            }
+
+    def headers(self):
+        """Server-Timing and usage response headers"""
+        stats = self.as_dict()
+        timing = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in stats['stages'].items()]
+        timing.append(f"total;dur={stats['seconds'] * 1000:.1f}")
+        usage = [f'{name}={stats[name]}' for name in self.COUNTS] + [f"cost_usd={stats['cost_usd']}"]
+        return {'Server-Timing': ', '.join(timing), 'X-Nasha-Usage': '; '.join(usage)}
+
+    def finish(self):
+        """Add this request's stats to the process metrics, once"""
+        if self.finished:
+            return
+        self.finished = True
+        stats = self.as_dict()
+        labels = {'endpoint': self.endpoint, 'platform': self.platform}
+        metrics.inc('nasha_requests_total', **labels)
+        metrics.inc('nasha_request_seconds_total', stats['seconds'], **labels)
+        for name, seconds in stats['stages'].items():
+            metrics.inc('nasha_stage_seconds_total', seconds, stage=name, **labels)
+        metrics.inc('nasha_rows_total', stats['rows'], **labels)
+        metrics.inc('nasha_batches_total', stats['batches'], **labels)
+        metrics.inc('nasha_model_calls_total', stats['calls'], **labels)
+        metrics.inc('nasha_retries_total', stats['retries'], **labels)
+        metrics.inc('nasha_repaired_rows_total', stats['repaired_rows'], **labels)
+        metrics.inc('nasha_hedged_calls_total', stats['hedged_calls'], **labels)
+        metrics.inc('nasha_escalated_rows_total', stats['escalated_rows'], **labels)
+        for kind in ('input', 'output', 'cache_creation_input', 'cache_read_input'):
+            metrics.inc('nasha_tokens_total', stats[f'{kind}_tokens'], type=kind, **labels)
+        metrics.inc('nasha_cost_usd_total', stats['cost_usd'], **labels)
+        if METRICS_LOG:
+            app.logger.info(json.dumps({'event': 'nasha_request', **stats}))
+
+
+_current_stats = contextvars.ContextVar('nasha_request_stats', default=None)
+
+
+@contextmanager
+def tracking(stats):
+    """Attribute stages and model usage in this context to stats"""
+    token = _current_stats.set(stats)
     try:
-        file = request.files['file']
-        
-        # Read CSV
-        content = file.read().decode('utf-8-sig')
-        reader = csv.DictReader(io.StringIO(content))
-        rows = list(reader)
-        
-        if len(rows) == 0:
-            return jsonify({'error': 'No data found in CSV'}), 400
-        
-        # Get API key
-        api_key = os.environ.get('ANTHROPIC_API_KEY')
-        if not api_key:
-            return jsonify({'error': 'ANTHROPIC_API_KEY not set'}), 500
-        
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        # Analyze ALL products in batches
-        all_analysis = []
-        batch_size = 20
-        
-        for i in range(0, len(rows), batch_size):
-            batch = rows[i:i+batch_size]
-            
-            analysis_prompt = f"""{PRODUCT_TAXONOMY}
+        yield stats
+    finally:
+        _current_stats.reset(token)
 
-Analyze these {len(batch)} products. For EACH product, determine:
-1. Main Category: Hash, Rosin, Flower, Vape, Preroll, or 5-Pack Preroll
-2. Subcategory: The specific type from the list above
-3. Type: Sativa/Indica/Hybrid (from (S)/(I)/(H) markers in name)
 
-Products:
-{json.dumps(batch, indent=2)}
+def iter_tracked(stats, chunks):
+    """Re-enter stats around each step of a streamed response, finishing it at the end"""
+    try:
+        while True:
+            with tracking(stats):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        stats.finish()
 
-Return ONLY a JSON array with one object per product:
-[{{"main_category": "...", "subcategory": "...", "type": "..."}}, ...]
 
-NO markdown, NO explanation."""
-            
-            response = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=5000,
-                messages=[{"role": "user", "content": analysis_prompt}]
-            )
-            
-            # Parse response
-            response_text = response.content[0].text.strip()
-            response_text = response_text.replace('```json', '').replace('```', '').strip()
-            
-            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if json_match:
-                batch_analysis = json.loads(json_match.group())
-                all_analysis.extend(batch_analysis)
-        
-        # Count categories
-        category_counts = {}
-        for item in all_analysis:
-            subcategory = item.get('subcategory', 'Unknown')
-            category_counts[subcategory] = category_counts.get(subcategory, 0) + 1
-        
-        return jsonify({
-            'total_products': len(rows),
-            'categories': category_counts,
-            'success': True
-        })
-        
-    except Exception as e:
-        import traceback
-        return jsonify({
-            'error': str(e), 
-            'details': traceback.format_exc()
-        }), 500
+def record(**counts):
+    """Add counts to the current request's stats, if any"""
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.add(**counts)
 
-@app.route('/transform', methods=['POST'])
-def transform():
-    """Transform CSV to platform format using AI"""
+
+def record_usage(model, usage, discount=1.0):
+    """Count a model call's tokens and estimated cost"""
+    tokens = {
+        'input_tokens': getattr(usage, 'input_tokens', 0) or 0,
+        'output_tokens': getattr(usage, 'output_tokens', 0) or 0,
+        'cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+        'cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', 0) or 0,
+    }
+    prices = MODEL_PRICING.get(model, {})
+    cost = discount * (
+        tokens['input_tokens'] * prices.get('input', 0)
+        + tokens['output_tokens'] * prices.get('output', 0)
+        + tokens['cache_creation_input_tokens'] * prices.get('cache_creation', 0)
+        + tokens['cache_read_input_tokens'] * prices.get('cache_read', 0)
+    ) / 1_000_000
+    record(calls=1, cost=cost, **tokens)
+
+
+def record_stage(name, seconds):
+    """Add time to a pipeline stage of the current request, if any"""
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.add_stage(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as a pipeline stage of the current request"""
+    start = time.perf_counter()
     try:
-        file = request.files['file']
-        platform = request.form['platform']
-        
-        # Read CSV
-        content = file.read().decode('utf-8-sig')
-        reader = csv.DictReader(io.StringIO(content))
-        rows = list(reader)
-        
-        # Get API key
-        api_key = os.environ.get('ANTHROPIC_API_KEY')
-        if not api_key:
-            return jsonify({'error': 'ANTHROPIC_API_KEY not set'}), 500
-        
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        # Define exact platform column structures
-        platform_columns = {
-            'weedmaps': [
-                'name', 'categories', 'description', 'avatar_image', 'product_id',
-                'external_id', 'sku', 'gallery_images', 'featured', 'tags',
-                'thc_percentage', 'thc_milligrams', 'cbd_percentage', 'cbd_milligrams',
-                'genetics', 'strain', 'items_per_pack', 'msrp', 'weight'
-            ],
-            'leafly': [
-                'Leafly Product ID', 'Name', 'SKU', 'Description', 'Category',
-                'Subcategory', 'Strain', 'THC Content', 'THC Unit', 'CBD Content',
-                'CBD Unit', 'Country Availability', 'State/Province Availability',
-                'External Link URL', 'Image One URL', 'Image Two URL',
-                'Image Three URL', 'Image Four URL', 'Image Five URL'
-            ],
-            'iheartjane': [
-                ' ', 'Strain', 'Brand Category',
-                'Does this Product Come in Standard Pack Sizes of 0.5g (500mg) or 1g (1000mg)?',
-                'Pack Size Next Steps', 'Enter Non-Standard Pack Size Here [g]',
-                'Lineage', 'Product Name (Internal Use)', 'Product Description',
-                'IMAGE LINK ONLY (PLEASE ATTACH IMAGES TO EMAIL IF YOU DON\'T HAVE A LINK)',
-                'Jane Use: Click here when product is added', '', ''
-            ],
-            'squarespace': [
-                'Product ID [Non Editable]', 'Variant ID [Non Editable]',
-                'Product Type [Non Editable]', 'Product Page', 'Product URL',
-                'Title', 'Description', 'SKU', 'Option Name 1', 'Option Value 1',
-                'Option Name 2', 'Option Value 2', 'Option Name 3', 'Option Value 3',
-                'Option Name 4', 'Option Value 4', 'Option Name 5', 'Option Value 5',
-                'Option Name 6', 'Option Value 6', 'Price', 'Sale Price', 'On Sale',
-                'Stock', 'Categories', 'Tags', 'Weight', 'Length', 'Width',
-                'Height', 'Visible', 'Hosted Image URLs'
-            ]
-        }
-        
-        # Process in batches
-        transformed_rows = []
-        batch_size = 3
-        
-        for i in range(0, len(rows), batch_size):
-            batch = rows[i:i+batch_size]
-            
-            transform_prompt = f"""{PRODUCT_TAXONOMY}
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
 
-Transform these {len(batch)} products to {platform} format.
 
-EXACT COLUMNS REQUIRED (in this order):
-{json.dumps(platform_columns[platform], indent=2)}
+def iter_upload_rows(binary_stream):
+    """Decode and parse a CSV byte stream incrementally, yielding one dict per row.
 
-CRITICAL RULES:
-1. Extract (S)=Sativa, (I)=Indica, (H)=Hybrid from product name
-2. Parse descriptions to extract and organize:
-   - THC (percentage or mg value)
-   - LINEAGE (genetic cross)
-   - TASTE (flavor profile)
-   - FEELING (effects)
-   - FARM (farm name)
-   - PLACE GROWN (location)
-   - Full marketing description (paragraph about the strain/product)
-3. For Weedmaps/Leafly/I Heart Jane: Description = THC + LINEAGE + TASTE + FEELING + Full marketing description (REMOVE only FARM and PLACE GROWN lines)
-   Example: Keep "THC: 35%\\nLINEAGE: OG x Skunk #1\\nTASTE: Earthy pine, citrus\\nFEELING: Relaxed, focused\\n\\nOGxSkunk1 is a Indica hybrid cannabis strain..." but remove "FARM: Clear Water Farms" and "PLACE GROWN: Humboldt, CA"
-   IMPORTANT: For Leafly, leave THC Content and THC Unit columns EMPTY - keep THC info in description only
-4. For Squarespace: Description = THC + LINEAGE + TASTE + FEELING + FARM + PLACE GROWN + Full marketing description (KEEP EVERYTHING)
-5. Clean strain name = remove product type keywords, keep only strain name
-   - For Squarespace Title: Extract ONLY the strain name, remove ALL product type info, weight, farm name
-   - Examples: "Jelly Donutz #117 Green Unpressed Hash (S)" → Title: "Jelly Donutz #117"
-              "Banana OG x GMO Cold Cure Live Rosin" → Title: "Banana OG x GMO"
-              "Moroccan Peaches Live Rosin All-In-One Vape 1g" → Title: "Moroccan Peaches"
-6. WEIGHT EXTRACTION RULES (CRITICAL):
-   - If "5 Pack" or "5-Pack" in name → weight is ALWAYS "2.5g" (total for 5-pack)
-   - Otherwise extract weight from name (0.5g, 1g, 3.5g, 7g, 14g, etc.)
-7. Map main category to platform categories using these mappings:
-   {json.dumps(PLATFORM_MAPPINGS, indent=2)}
-8. FOR SQUARESPACE ONLY - Generate Product URL:
-   - Take clean strain name (e.g., "Acai Mints")
-   - Add farm name if available (e.g., "Whitethorn Valley")
-   - Convert to lowercase, replace spaces with hyphens, remove special characters
-   - Example: "Acai Mints" + "Whitethorn Valley" → "acai-mints-whitethorn-valley"
-   - Example: "Banana OG x GMO" + "Clear Water Farms" → "banana-og-x-gmo-clear-water-farms"
-   - For prerolls with batch numbers: "submerge-batch-28" or "altitude-batch-20"
+    Werkzeug spools uploads over 500KB to a temporary file, so reading through
+    file.stream keeps memory bounded by the batch window, not the file size.
+    """
+    stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.DictReader(stream)
+        while True:
+            with stage('csv_parse'):
+                row = next(reader, None)
+            if row is None:
+                break
+            record(rows=1)
+            yield row
+    finally:
+        # Leave the underlying upload stream open for Werkzeug to clean up
+        stream.detach()
 
-FIELD MAPPING INSTRUCTIONS FOR {platform.upper()}:
 
-{"WEEDMAPS:" if platform == 'weedmaps' else ""}
-{"- name: Full product name" if platform == 'weedmaps' else ""}
-{"- categories: Mapped category (e.g., 'Ice Water Hash, Solventless, Concentrates')" if platform == 'weedmaps' else ""}
-{"- description: Description without FARM/PLACE" if platform == 'weedmaps' else ""}
-{"- avatar_image: Photo link" if platform == 'weedmaps' else ""}
-{"- product_id: (leave empty)" if platform == 'weedmaps' else ""}
-{"- external_id: Batch number" if platform == 'weedmaps' else ""}
-{"- sku: (leave empty)" if platform == 'weedmaps' else ""}
-{"- gallery_images: Photo link" if platform == 'weedmaps' else ""}
-{"- featured: FALSE" if platform == 'weedmaps' else ""}
-{"- tags: From FEELING field (comma-separated)" if platform == 'weedmaps' else ""}
-{"- thc_percentage: THC value without %" if platform == 'weedmaps' else ""}
-{"- thc_milligrams: (leave empty)" if platform == 'weedmaps' else ""}
-{"- cbd_percentage: (leave empty)" if platform == 'weedmaps' else ""}
-{"- cbd_milligrams: (leave empty)" if platform == 'weedmaps' else ""}
-{"- genetics: Sativa/Indica/Hybrid" if platform == 'weedmaps' else ""}
-{"- strain: Clean strain name" if platform == 'weedmaps' else ""}
-{"- items_per_pack: 5 for 5-packs, 1 otherwise" if platform == 'weedmaps' else ""}
-{"- msrp: (leave empty)" if platform == 'weedmaps' else ""}
-{"- weight: Extracted weight (0.5g, 1g, 2.5g, 3.5g, etc.)" if platform == 'weedmaps' else ""}
-
-{"LEAFLY:" if platform == 'leafly' else ""}
-{"- All 19 columns must be present" if platform == 'leafly' else ""}
-{"- Empty fields: Leafly Product ID, THC Content, THC Unit, CBD Content, CBD Unit, External Link URL, Image Two/Three/Four/Five URL" if platform == 'leafly' else ""}
-{"- THC Content: LEAVE EMPTY (keep THC info in description instead)" if platform == 'leafly' else ""}
-{"- THC Unit: LEAVE EMPTY" if platform == 'leafly' else ""}
-{"- Description: Include THC information along with LINEAGE, TASTE, FEELING (no FARM/PLACE)" if platform == 'leafly' else ""}
-{"- Country Availability: US" if platform == 'leafly' else ""}
-{"- State/Province Availability: CA" if platform == 'leafly' else ""}
-
-{"I HEART JANE:" if platform == 'iheartjane' else ""}
-{"- First column ' ': Nasha" if platform == 'iheartjane' else ""}
-{"- Product Name (Internal Use): Nasha | Strain | Category | Weight | Type" if platform == 'iheartjane' else ""}
-{"- Standard Pack Sizes: YES for 0.5g/1g, NO otherwise" if platform == 'iheartjane' else ""}
-{"- Last two columns '': leave empty" if platform == 'iheartjane' else ""}
-
-{"SQUARESPACE:" if platform == 'squarespace' else ""}
-{"- All 32 columns must be present" if platform == 'squarespace' else ""}
-{"- Product Type [Non Editable]: PHYSICAL" if platform == 'squarespace' else ""}
-{"- Product Page: Based on category (hash-library, rosin-library, flower-library, vape-library, infused-preroll-library)" if platform == 'squarespace' else ""}
-{"- Product URL: Generate as: strain-name-farm-name (lowercase, hyphens, URL-safe). Example: 'Acai Mints' + 'Whitethorn Valley' = 'acai-mints-whitethorn-valley'" if platform == 'squarespace' else ""}
-{"- Title: Clean strain name ONLY (no product type, no farm). Example: 'Acai Mints', 'Banana OG x GMO'" if platform == 'squarespace' else ""}
-{"- Description: HTML format with <p> and <br> tags. Include FARM and PLACE GROWN. Format: <p class=\"\">LINEAGE: ...<br>TASTE: ...<br>FEELING: ...<br>FARM: ...<br>PLACE GROWN: ...</p><p class=\"\">Full marketing paragraph...</p>" if platform == 'squarespace' else ""}
-{"- Categories: / + first letter of strain name (lowercase). Example: 'Acai Mints' = '/a', 'Banana OG' = '/b'. Use '/category' for names starting with numbers/symbols" if platform == 'squarespace' else ""}
-{"- Tags: Farm name only" if platform == 'squarespace' else ""}
-{"- Price/Sale Price: 0.00" if platform == 'squarespace' else ""}
-{"- On Sale: No" if platform == 'squarespace' else ""}
-{"- Stock: Unlimited" if platform == 'squarespace' else ""}
-{"- Visible: Yes" if platform == 'squarespace' else ""}
-{"- Weight/Length/Width/Height: 0.0" if platform == 'squarespace' else ""}
-{"- All empty fields: leave as empty string" if platform == 'squarespace' else ""}
+def iter_bulk_sources(files):
+    """(filename, binary stream) for each uploaded CSV, expanding zip archives.
 
-Products to transform:
-{json.dumps(batch, indent=2)}
+    Each stream is only valid until the next one is yielded.
+    """
+    for file in files:
+        if not file.filename.lower().endswith('.zip'):
+            yield file.filename, file.stream
+            continue
+        with zipfile.ZipFile(file.stream) as archive:
+            for info in archive.infolist():
+                name = info.filename
+                if info.is_dir() or not name.lower().endswith('.csv') or name.startswith('__MACOSX/'):
+                    continue
+                with archive.open(info) as member:
+                    yield name, member
 
-Return ONLY a JSON array of objects. Each object MUST have ALL {len(platform_columns[platform])} columns in the exact order listed above. Use empty string "" for empty fields. NO markdown, NO explanation."""
 
-            response = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=8000,
-                messages=[{"role": "user", "content": transform_prompt}]
-            )
-            
-            # Parse response
-            response_text = response.content[0].text.strip()
-            response_text = response_text.replace('```json', '').replace('```', '').strip()
-            
-            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if json_match:
-                batch_transformed = json.loads(json_match.group())
-                
-                # Ensure all required columns are present for each row
-                for row in batch_transformed:
-                    for col in platform_columns[platform]:
-                        if col not in row:
-                            row[col] = ''  # Add missing column with empty value
-                    
-                    # Ensure columns are in correct order
-                    ordered_row = {col: row.get(col, '') for col in platform_columns[platform]}
-                    transformed_rows.append(ordered_row)
+def iter_bulk_rows(files, names, starts):
+    """Rows of every uploaded CSV in turn, as one stream.
+
+    Appends each file's output name to names and the position of its first
+    row to starts as the file is reached, so bisecting starts maps a row
+    position back to its file.
+    """
+    position = 0
+    for filename, stream in iter_bulk_sources(files):
+        stem = os.path.splitext(os.path.basename(filename))[0] or 'upload'
+        names.append(stem if stem not in names else f'{stem}-{len(names) + 1}')
+        starts.append(position)
+        for row in iter_upload_rows(stream):
+            position += 1
+            yield row
+
+
+def peek_rows(rows):
+    """First row and an iterator still yielding every row, or (None, empty iterator)"""
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return None, iter(())
+    return first_row, chain([first_row], rows)
+
+
+class CountingIterator:
+    """Iterator wrapper that counts the items pulled through it"""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._iterator)
+        self.count += 1
+        return item
+
+
+class RateLimitBackoff:
+    """Shared cool-down so every worker thread pauses after a 429/529"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self, sleep=time.sleep):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def trip(self, delay):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+
+_backoff = RateLimitBackoff()
+
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retrying, honouring the server's retry-after"""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+class CallAbandoned(Exception):
+    """A model call whose result is no longer wanted, stopped before its next request or chunk"""
+
+
+# Cancel events of the call on this thread and every call that started it, innermost
+# first; once any is set, the call sends no more requests and stops reading
+_call_cancelled = contextvars.ContextVar('nasha_call_cancelled', default=())
+
+# Model call slots shared by a pipeline's spans and every call they start
+_call_slots = contextvars.ContextVar('nasha_call_slots', default=None)
+
+
+def raise_if_cancelled():
+    """Raise CallAbandoned if the current call's result is no longer wanted"""
+    if any(cancelled.is_set() for cancelled in _call_cancelled.get()):
+        raise CallAbandoned()
+
+
+def pause(delay):
+    """time.sleep(delay), cut short by CallAbandoned if the current call is cancelled"""
+    events = _call_cancelled.get()
+    if not events:
+        time.sleep(delay)
+        return
+    resume_at = time.monotonic() + delay
+    while time.monotonic() < resume_at:
+        raise_if_cancelled()
+        # Only the innermost event wakes the wait; outer ones are seen within 0.1s
+        events[0].wait(min(0.1, max(0.0, resume_at - time.monotonic())))
+    raise_if_cancelled()
+
+
+def limiting_calls(slots, func, *args):
+    """func(*args) with its model requests, and those of calls it starts, taking slots"""
+    _call_slots.set(slots)
+    return func(*args)
+
+
+@contextmanager
+def model_call_slot():
+    """Hold one of the pipeline's model call slots, if it has any, while a request is open"""
+    slots = _call_slots.get()
+    if slots is None:
+        yield
+        return
+    while not slots.acquire(timeout=0.1):
+        raise_if_cancelled()
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+# Error event types the API can send mid-stream, on a response that began as 200
+STREAM_ERROR_STATUS = {'rate_limit_error': 429, 'overloaded_error': 529}
+
+
+def error_status(error):
+    """HTTP status an API error stands for, reading an error event's type
+    when it arrived mid-stream"""
+    detail = error.body.get('error') if isinstance(error.body, dict) else None
+    error_type = detail.get('type') if isinstance(detail, dict) else None
+    return STREAM_ERROR_STATUS.get(error_type, error.status_code)
+
+
+def with_backoff(call):
+    """Run call() with backoff on rate limits, overloads and transient errors.
+
+    A cancelled call stops before its next attempt or while backing off.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        _backoff.wait(pause)
+        raise_if_cancelled()
+        try:
+            return call()
+        except anthropic.APIStatusError as e:
+            status = error_status(e)
+            if status not in RETRYABLE_STATUS or attempt == MAX_RETRIES:
+                raise
+            record(retries=1)
+            delay = retry_delay(e, attempt)
+            if status in THROTTLE_STATUS:
+                _backoff.trip(delay)
             else:
-                # Try parsing whole response
-                batch_transformed = json.loads(response_text)
-                if isinstance(batch_transformed, list):
-                    transformed_rows.extend(batch_transformed)
-                else:
-                    transformed_rows.append(batch_transformed)
-        
-        # Generate CSV with exact column order
-        if not transformed_rows:
-            return jsonify({'error': 'No data transformed'}), 500
-        
-        output = io.StringIO()
-        writer = csv.DictWriter(output, fieldnames=platform_columns[platform])
-        writer.writeheader()
-        writer.writerows(transformed_rows)
-        
-        # Return file
-        output.seek(0)
-        return send_file(
-            io.BytesIO(output.getvalue().encode('utf-8')),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'Nasha_{platform}.csv'
-        )
-        
-    except Exception as e:
-        import traceback
-        return jsonify({
-            'error': str(e),
-            'details': traceback.format_exc()
-        }), 500
+                pause(delay)
+        except anthropic.APIConnectionError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            record(retries=1)
+            pause(retry_delay(e, attempt))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Process-wide Anthropic client, sharing one keep-alive connection pool.
+
+    SDK retries are off; with_backoff retries so the backoff is shared
+    across threads.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = anthropic.Anthropic(
+                api_key=os.environ.get('ANTHROPIC_API_KEY'),
+                max_retries=0,
+                timeout=httpx.Timeout(API_TIMEOUT, connect=API_CONNECT_TIMEOUT),
+                http_client=anthropic.DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE,
+                        keepalive_expiry=KEEPALIVE_EXPIRY,
+                    )
+                ),
+            )
+        return _client
+
+
+def dispatch_ordered(func, items, max_in_flight=None, deadline=None, on_timeout=None):
+    """Run func over items on a thread pool, yielding results in input order.
+
+    At most max_in_flight calls run at once and only a small window of items
+    is pulled from the iterable ahead of the results being consumed. With a
+    deadline (a time.monotonic() value), an item not finished by then yields
+    on_timeout(item) instead, and later items are passed straight to it.
+    Calls still running then, or when the results stop being consumed, are
+    cancelled.
+    """
+    max_in_flight = max(1, max_in_flight or MAX_IN_FLIGHT)
+    pool = ThreadPoolExecutor(max_workers=max_in_flight)
+    pending = deque()
+    # Set once no further results are wanted; model calls under it stop sending requests
+    abandoned = threading.Event()
+
+    def run(item):
+        _call_cancelled.set((abandoned,) + _call_cancelled.get())
+        return func(item)
+
+    def result(item, future):
+        if deadline is not None:
+            wait([future], timeout=max(0.0, deadline - time.monotonic()))
+            if not future.done():
+                abandoned.set()
+                return on_timeout(item)
+        return future.result()
+
+    items = iter(items)
+    try:
+        for item in items:
+            if deadline is not None and time.monotonic() >= deadline:
+                items = chain([item], items)
+                break
+            # Each task runs in a copy of this context so request stats follow it
+            pending.append((item, pool.submit(contextvars.copy_context().run, run, item)))
+            if len(pending) >= max_in_flight * 2:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+        # Only items left over once the deadline passed remain
+        for item in items:
+            yield on_timeout(item)
+    finally:
+        abandoned.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class LatencyTracker:
+    """Recent model call latencies per namespace, for choosing when to hedge"""
+
+    def __init__(self, size=200):
+        self.size = size
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def add(self, namespace, seconds):
+        with self._lock:
+            self._samples.setdefault(namespace, deque(maxlen=self.size)).append(seconds)
+
+    def percentile(self, namespace, fraction):
+        """Latency below which fraction of recent calls finished, or None with too few calls"""
+        with self._lock:
+            samples = sorted(self._samples.get(namespace, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+call_latencies = LatencyTracker()
+
+
+def start_call(func, *args):
+    """Run func(*args) on its own thread in a copy of this context: (future, cancel event)"""
+    future, cancelled = Future(), threading.Event()
+    # Cancelling the call that starts this one cancels this one too
+    outer = _call_cancelled.get()
+
+    def target():
+        _call_cancelled.set((cancelled,) + outer)
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(target,), name='nasha-call', daemon=True).start()
+    return future, cancelled
+
+
+def call_with_deadline(namespace, batch_func, batch):
+    """batch_func(batch) within NASHA_CALL_DEADLINE, hedged once it runs long.
+
+    When the call has taken longer than NASHA_HEDGE_PERCENTILE of recent
+    calls for the namespace, a duplicate is sent; the first to finish,
+    result or error, is used and the other abandoned.
+    """
+    hedge_after = call_latencies.percentile(namespace, HEDGE_PERCENTILE) if HEDGE_PERCENTILE else None
+    started = time.monotonic()
+    if not CALL_DEADLINE and hedge_after is None:
+        result = batch_func(batch)
+        call_latencies.add(namespace, time.monotonic() - started)
+        return result
+
+    deadline = started + CALL_DEADLINE if CALL_DEADLINE else None
+    attempts = [start_call(batch_func, batch)]
+    try:
+        while True:
+            hedge_at = started + hedge_after if hedge_after is not None and len(attempts) == 1 else None
+            wakes = [t for t in (deadline, hedge_at) if t is not None]
+            timeout = max(0.0, min(wakes) - time.monotonic()) if wakes else None
+            done, _ = wait([future for future, cancelled in attempts], timeout=timeout, return_when=FIRST_COMPLETED)
+            if done:
+                finished = done.pop()
+                if finished.exception() is None:
+                    call_latencies.add(namespace, time.monotonic() - started)
+                return finished.result()
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f'Model call exceeded {CALL_DEADLINE:g}s deadline')
+            if hedge_at is not None:
+                record(hedged_calls=1)
+                attempts.append(start_call(batch_func, batch))
+    finally:
+        for future, cancelled in attempts:
+            cancelled.set()
+
+
+class OutputTruncated(Exception):
+    """A model response stopped at max_tokens before its JSON array was complete.
+
+    rows holds the elements that were complete before the cut-off.
+    """
+
+    def __init__(self, rows):
+        super().__init__(f'Response hit max_tokens after {len(rows)} complete rows')
+        self.rows = rows
+
+
+def split_on_truncation(batch_func, batch):
+    """batch_func over batch, re-sending whatever a truncated response didn't cover.
+
+    Rows completed before the cut-off are kept; if none were, the batch is
+    halved and each half retried.
+    """
+    try:
+        return batch_func(batch)
+    except OutputTruncated as e:
+        if e.rows:
+            rest = batch[len(e.rows):]
+            return e.rows + (split_on_truncation(batch_func, rest) if rest else [])
+        if len(batch) < 2:
+            raise
+        middle = len(batch) // 2
+        return split_on_truncation(batch_func, batch[:middle]) + split_on_truncation(batch_func, batch[middle:])
+
+
+class JsonArrayParser:
+    """Incremental parser for a JSON array arriving in text chunks.
+
+    feed() returns each element as soon as it is complete. Text before the
+    opening bracket (prose, ```json fences) is skipped, and an element that
+    fails to parse comes back as None so later elements keep their positions.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.finished = False
+        self._element = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        elements = []
+        for char in text:
+            if self.finished:
+                break
+            if not self.started:
+                self.started = char == '['
+                continue
+            if self._in_string:
+                self._element.append(char)
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if self._depth == 0 and char in ',]':
+                # Scalars, or leftovers after a malformed element, end at the separator
+                if ''.join(self._element).strip():
+                    elements.append(self._decode())
+                self._element = []
+                self.finished = char == ']'
+                continue
+            self._element.append(char)
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth = max(self._depth - 1, 0)
+                if self._depth == 0:
+                    # An object or array element is complete at its closing bracket
+                    elements.append(self._decode())
+                    self._element = []
+        return elements
+
+    def _decode(self):
+        try:
+            return json.loads(''.join(self._element))
+        except ValueError:
+            return None
+
+
+def stream_rows(client, convert=None, **kwargs):
+    """Stream a model call, parsing each element of its JSON array as it completes.
+
+    Malformed elements come back as None; others are passed through convert.
+    An overload or rate limit reported mid-stream retries the whole call,
+    dropping the rows read so far. Raises OutputTruncated if the response
+    stopped at max_tokens.
+    """
+    return with_backoff(partial(read_stream, client, convert, kwargs))
+
+
+def read_stream(client, convert, kwargs):
+    """The converted elements of one streamed model call"""
+    with model_call_slot():
+        started = time.perf_counter()
+        parse_seconds = 0.0
+        manager = client.messages.stream(**kwargs)
+        stream = manager.__enter__()
+        parser = JsonArrayParser()
+        completed = []
+        try:
+            for text in stream.text_stream:
+                raise_if_cancelled()
+                parse_started = time.perf_counter()
+                completed += [convert(element) if convert and element is not None else element
+                              for element in parser.feed(text)]
+                parse_seconds += time.perf_counter() - parse_started
+            message = stream.get_final_message()
+        finally:
+            manager.__exit__(None, None, None)
+
+    record_stage('model', time.perf_counter() - started - parse_seconds)
+    record_stage('response_parse', parse_seconds)
+    record_usage(kwargs['model'], message.usage)
+
+    if message.stop_reason == 'max_tokens':
+        raise OutputTruncated(completed)
+    if not parser.started:
+        # No array in the response; accept a lone object
+        return [convert(element) if convert else element for element in parse_json_array(message.content[0].text)]
+    return completed
+
+
+def parse_json_array(response_text):
+    """Extract the JSON array from a model response"""
+    response_text = response_text.strip()
+    response_text = response_text.replace('```json', '').replace('```', '').strip()
+
+    json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
+    if json_match:
+        return json.loads(json_match.group())
+
+    # Try parsing whole response
+    parsed = json.loads(response_text)
+    return parsed if isinstance(parsed, list) else [parsed]
+
+
+# Static analysis instructions, sent as a cacheable system prefix
+ANALYSIS_INSTRUCTIONS = f"""{PRODUCT_TAXONOMY}
+
+For EACH product, determine:
+1. Main Category: Hash, Rosin, Flower, Vape, Preroll, or 5-Pack Preroll
+2. Subcategory: The specific type from the list above
+3. Type: Sativa/Indica/Hybrid (from (S)/(I)/(H) markers in name)
+
+Return ONLY a JSON array with one object per product, in the order given:
+[{{"main_category": "...", "subcategory": "...", "type": "..."}}, ...]
+
+NO markdown, NO explanation."""
+
+
+def build_analysis_message(batch):
+    """Per-batch user message asking the model to categorize the rows"""
+    return f"""Analyze these {len(batch)} products.
+
+Products:
+{json.dumps(batch, indent=2)}"""
+
+
+def checked_analysis(analysis):
+    """A fast-model analysis, or None to escalate its row when its subcategory isn't in the taxonomy"""
+    if not isinstance(analysis, dict) or analysis.get('subcategory') not in TAXONOMY_SUBCATEGORIES:
+        return None
+    return analysis
+
+
+def analyze_batch(client, batch, model=MODEL_NAME):
+    """Categorize one batch of rows, returning one analysis object per row"""
+    try:
+        return stream_rows(
+            client,
+            None if model == MODEL_NAME else checked_analysis,
+            model=model,
+            max_tokens=ANALYSIS_MAX_TOKENS,
+            system=cached_system(ANALYSIS_INSTRUCTIONS),
+            messages=[{"role": "user", "content": build_analysis_message(batch)}]
+        )
+    except ValueError:
+        # A response without a JSON array contributes nothing
+        return []
+
+
+# Static record extraction instructions, sent as a cacheable system prefix
+EXTRACTION_INSTRUCTIONS = f"""{PRODUCT_TAXONOMY}
+
+Extract a normalized product record from each product.
+
+RECORD FIELDS:
+- name: Full product name
+- strain: Clean strain name ONLY (no product type, weight, farm or (S)/(I)/(H) marker)
+- genetics: Sativa/Indica/Hybrid from (S)/(I)/(H) marker in name, else ""
+- category: One of {json.dumps(list(CATEGORY_LABELS))}
+- subcategory: The specific subcategory from the taxonomy above
+- weight: "2.5g" if "5 Pack" or "5-Pack" in name, otherwise weight from name (0.5g, 1g, 3.5g, 7g, 14g, etc.)
+- thc: THC value as written (e.g. "35%")
+- lineage: LINEAGE (genetic cross)
+- taste: TASTE (flavor profile)
+- feeling: FEELING (effects)
+- farm: FARM (farm name)
+- place: PLACE GROWN (location)
+- marketing: Full marketing description (paragraph about the strain/product)
+- photo: Photo link
+- batch: Batch number
+- sku: SKU
+
+Return ONLY a JSON array with one object per product, in the same order, each with ALL {len(RECORD_FIELDS)} fields. Use empty string "" for missing fields. NO markdown, NO explanation."""
+
+
+def build_extraction_message(batch):
+    """Per-batch user message asking for one record per row"""
+    return f"""Extract a normalized product record from each of these {len(batch)} products.
+
+Products:
+{json.dumps(batch, indent=2)}"""
+
+
+def normalize_record(record):
+    """Coerce a model-extracted record into the shape parse_product produces"""
+    normalized = {field: record.get(field) or '' for field in RECORD_FIELDS}
+    for field in RECORD_FIELDS:
+        if field != 'marketing' and not isinstance(normalized[field], str):
+            normalized[field] = str(normalized[field])
+    marketing = normalized['marketing']
+    if isinstance(marketing, str):
+        marketing = [p.strip() for p in re.split(r'\n\s*\n', marketing) if p.strip()]
+    normalized['marketing'] = [' '.join(str(p).split()) for p in marketing]
+    if normalized['category'] not in CATEGORY_LABELS:
+        normalized['category'] = detect_category(normalized['name'])[0] or ''
+    return normalized
+
+
+def checked_record(record):
+    """A fast-model record normalized, or None to escalate its row when its category is unknown"""
+    if not isinstance(record, dict) or record.get('category') not in CATEGORY_LABELS:
+        return None
+    return normalize_record(record)
+
+
+def extract_batch(client, batch, model=MODEL_NAME):
+    """Extract one intermediate product record per row in a batch"""
+    try:
+        return stream_rows(
+            client,
+            normalize_record if model == MODEL_NAME else checked_record,
+            model=model,
+            max_tokens=EXTRACTION_MAX_TOKENS,
+            system=cached_system(EXTRACTION_INSTRUCTIONS),
+            messages=[{"role": "user", "content": build_extraction_message(batch)}]
+        )
+    except json.JSONDecodeError:
+        # No JSON array in the response; the batch's rows are reported as missing
+        return []
+
+
+def render_export_zip(records, platforms, missing=None):
+    """Zip archive holding one CSV per platform, all rendered from the same records"""
+    return render_zip(((None, product) for product in records), platforms,
+                      lambda key, platform: f'Nasha_{platform}.csv', lambda: [None], missing)
+
+
+def render_zip(keyed_records, platforms, entry_name, keys, missing=None):
+    """Zip archive of platform CSVs rendered from (key, record) pairs.
+
+    entry_name(key, platform) names the CSV each record lands in; keys() is
+    called once records are exhausted, so every key gets its CSVs even with
+    no rows. If the missing list has been filled by then, it is added as
+    missing_rows.json.
+    """
+    # Records are consumed once, each rendered to every platform as it arrives
+    outputs, writers = {}, {}
+
+    def writer_for(name, platform):
+        if name not in writers:
+            outputs[name] = io.StringIO()
+            writers[name] = csv.writer(outputs[name])
+            writers[name].writerow(PLATFORM_COLUMNS[platform])
+        return writers[name]
+
+    for key, product in keyed_records:
+        with stage('render'):
+            for platform in platforms:
+                writer_for(entry_name(key, platform), platform).writerow(render_platform_row(product, platform))
+    for key in keys():
+        for platform in platforms:
+            writer_for(entry_name(key, platform), platform)
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(outputs):
+            zf.writestr(name, outputs[name].getvalue().encode('utf-8'))
+        if missing:
+            zf.writestr('missing_rows.json', json.dumps(missing, indent=2))
+    archive.seek(0)
+    return archive
+
+
+# Field mapping instructions sent to the model for each platform
+PLATFORM_FIELD_INSTRUCTIONS = {
+    'weedmaps': """WEEDMAPS:
+- name: Full product name
+- categories: Mapped category (e.g., 'Ice Water Hash, Solventless, Concentrates')
+- description: Description without FARM/PLACE
+- avatar_image: Photo link
+- product_id: (leave empty)
+- external_id: Batch number
+- sku: (leave empty)
+- gallery_images: Photo link
+- featured: FALSE
+- tags: From FEELING field (comma-separated)
+- thc_percentage: THC value without %
+- thc_milligrams: (leave empty)
+- cbd_percentage: (leave empty)
+- cbd_milligrams: (leave empty)
+- genetics: Sativa/Indica/Hybrid
+- strain: Clean strain name
+- items_per_pack: 5 for 5-packs, 1 otherwise
+- msrp: (leave empty)
+- weight: Extracted weight (0.5g, 1g, 2.5g, 3.5g, etc.)""",
+    'leafly': """LEAFLY:
+- All 19 columns must be present
+- Empty fields: Leafly Product ID, THC Content, THC Unit, CBD Content, CBD Unit, External Link URL, Image Two/Three/Four/Five URL
+- THC Content: LEAVE EMPTY (keep THC info in description instead)
+- THC Unit: LEAVE EMPTY
+- Description: Include THC information along with LINEAGE, TASTE, FEELING (no FARM/PLACE)
+- Country Availability: US
+- State/Province Availability: CA""",
+    'iheartjane': """I HEART JANE:
+- First column ' ': Nasha
+- Product Name (Internal Use): Nasha | Strain | Category | Weight | Type
+- Standard Pack Sizes: YES for 0.5g/1g, NO otherwise
+- Last two columns '': leave empty""",
+    'squarespace': """SQUARESPACE:
+- All 32 columns must be present
+- Product Type [Non Editable]: PHYSICAL
+- Product Page: Based on category (hash-library, rosin-library, flower-library, vape-library, infused-preroll-library)
+- Product URL: Generate as: strain-name-farm-name (lowercase, hyphens, URL-safe). Example: 'Acai Mints' + 'Whitethorn Valley' = 'acai-mints-whitethorn-valley'
+- Title: Clean strain name ONLY (no product type, no farm). Example: 'Acai Mints', 'Banana OG x GMO'
+- Description: HTML format with <p> and <br> tags. Include FARM and PLACE GROWN. Format: <p class="">LINEAGE: ...<br>TASTE: ...<br>FEELING: ...<br>FARM: ...<br>PLACE GROWN: ...</p><p class="">Full marketing paragraph...</p>
+- Categories: / + first letter of strain name (lowercase). Example: 'Acai Mints' = '/a', 'Banana OG' = '/b'. Use '/category' for names starting with numbers/symbols
+- Tags: Farm name only
+- Price/Sale Price: 0.00
+- On Sale: No
+- Stock: Unlimited
+- Visible: Yes
+- Weight/Length/Width/Height: 0.0
+- All empty fields: leave as empty string""",
+}
+
+
+def build_transform_instructions(platform):
+    """Static instruction block for a platform; identical for every batch"""
+    return f"""{PRODUCT_TAXONOMY}
+
+Transform products to {platform} format.
+
+EXACT COLUMNS REQUIRED (in this order):
+{json.dumps(PLATFORM_COLUMNS[platform], indent=2)}
+
+CRITICAL RULES:
+1. Extract (S)=Sativa, (I)=Indica, (H)=Hybrid from product name
+2. Parse descriptions to extract and organize:
+   - THC (percentage or mg value)
+   - LINEAGE (genetic cross)
+   - TASTE (flavor profile)
+   - FEELING (effects)
+   - FARM (farm name)
+   - PLACE GROWN (location)
+   - Full marketing description (paragraph about the strain/product)
+3. For Weedmaps/Leafly/I Heart Jane: Description = THC + LINEAGE + TASTE + FEELING + Full marketing description (REMOVE only FARM and PLACE GROWN lines)
+   Example: Keep "THC: 35%\\nLINEAGE: OG x Skunk #1\\nTASTE: Earthy pine, citrus\\nFEELING: Relaxed, focused\\n\\nOGxSkunk1 is a Indica hybrid cannabis strain..." but remove "FARM: Clear Water Farms" and "PLACE GROWN: Humboldt, CA"
+   IMPORTANT: For Leafly, leave THC Content and THC Unit columns EMPTY - keep THC info in description only
+4. For Squarespace: Description = THC + LINEAGE + TASTE + FEELING + FARM + PLACE GROWN + Full marketing description (KEEP EVERYTHING)
+5. Clean strain name = remove product type keywords, keep only strain name
+   - For Squarespace Title: Extract ONLY the strain name, remove ALL product type info, weight, farm name
+   - Examples: "Jelly Donutz #117 Green Unpressed Hash (S)" → Title: "Jelly Donutz #117"
+              "Banana OG x GMO Cold Cure Live Rosin" → Title: "Banana OG x GMO"
+              "Moroccan Peaches Live Rosin All-In-One Vape 1g" → Title: "Moroccan Peaches"
+6. WEIGHT EXTRACTION RULES (CRITICAL):
+   - If "5 Pack" or "5-Pack" in name → weight is ALWAYS "2.5g" (total for 5-pack)
+   - Otherwise extract weight from name (0.5g, 1g, 3.5g, 7g, 14g, etc.)
+7. Map main category to platform categories using these mappings:
+   {json.dumps(PLATFORM_MAPPINGS, indent=2)}
+8. FOR SQUARESPACE ONLY - Generate Product URL:
+   - Take clean strain name (e.g., "Acai Mints")
+   - Add farm name if available (e.g., "Whitethorn Valley")
+   - Convert to lowercase, replace spaces with hyphens, remove special characters
+   - Example: "Acai Mints" + "Whitethorn Valley" → "acai-mints-whitethorn-valley"
+   - Example: "Banana OG x GMO" + "Clear Water Farms" → "banana-og-x-gmo-clear-water-farms"
+   - For prerolls with batch numbers: "submerge-batch-28" or "altitude-batch-20"
+
+FIELD MAPPING INSTRUCTIONS FOR {platform.upper()}:
+
+{PLATFORM_FIELD_INSTRUCTIONS[platform]}
+
+Return ONLY a JSON array of objects, one per product in the order given. Each object MUST have ALL {len(PLATFORM_COLUMNS[platform])} columns in the exact order listed above. Use empty string "" for empty fields. NO markdown, NO explanation."""
+
+
+# Built once at startup and sent as a cacheable system prefix
+TRANSFORM_INSTRUCTIONS = {platform: build_transform_instructions(platform) for platform in PLATFORM_COLUMNS}
+
+
+def build_transform_message(batch, platform):
+    """Per-batch user message: only the product rows change between calls"""
+    return f"""Transform these {len(batch)} products to {platform} format.
+
+Products to transform:
+{json.dumps(batch, indent=2)}"""
+
+
+def cached_system(instructions):
+    """System prompt block marked for Anthropic prompt caching"""
+    return [{"type": "text", "text": instructions, "cache_control": {"type": "ephemeral"}}]
+
+
+def transform_params(platform, batch, model=MODEL_NAME):
+    """Messages API parameters for transforming one batch of rows"""
+    return {
+        'model': model,
+        'max_tokens': TRANSFORM_MAX_TOKENS,
+        'system': cached_system(TRANSFORM_INSTRUCTIONS[platform]),
+        'messages': [{"role": "user", "content": build_transform_message(batch, platform)}],
+    }
+
+
+def pad_platform_row(platform, row):
+    """Model output row as its values in platform column order, blank where missing.
+
+    Platform rows stay in this form through caching and checkpoints to
+    csv.writer, so column names aren't stored or looked up per row.
+    """
+    return [row.get(col, '') for col in PLATFORM_COLUMNS[platform]]
+
+
+def check_platform_row(platform, element):
+    """(values in column order, problems) for one model output element.
+
+    Fixed columns are set to their documented value, numbers stringified
+    and stray keys dropped. A missing column, a misnamed key or a nested
+    value is a problem only a repair call can fix.
+    """
+    if not isinstance(element, dict):
+        return None, ['not a JSON object']
+    fixed = PLATFORM_FIXED_VALUES[platform]
+    missing = [col for col in PLATFORM_COLUMNS[platform] if col not in element and col not in fixed]
+    problems = [f"missing {', '.join(repr(col) for col in missing)}"] if missing else []
+    unknown = [key for key in element if key not in PLATFORM_COLUMN_INDEX[platform]]
+    if unknown and missing:
+        # Likely the missing columns under another name
+        problems.append(f"unexpected {', '.join(repr(key) for key in unknown)}")
+    values = []
+    for col in PLATFORM_COLUMNS[platform]:
+        value = fixed[col] if col in fixed else element.get(col, '')
+        if value is None:
+            value = ''
+        elif isinstance(value, (int, float)):
+            value = str(value)
+        elif not isinstance(value, str):
+            problems.append(f'{col!r} is a {type(value).__name__}, not a string')
+            value = json.dumps(value, ensure_ascii=False)
+        values.append(value)
+    return values, problems
+
+
+REPAIR_INSTRUCTIONS = """Your previous output for these products did not match the required columns:
+{problems}
+
+Return one JSON object per product with exactly the {platform} columns as keys and string values."""
+
+
+def request_repair(client, platform, rows, problems):
+    """Checked output of a small call re-requesting only rows whose output failed"""
+    params = transform_params(platform, rows)
+    listing = '\n'.join(f"- Product {i}: {'; '.join(row_problems)}" for i, row_problems in enumerate(problems, 1))
+    params['messages'][0]['content'] += '\n\n' + REPAIR_INSTRUCTIONS.format(problems=listing, platform=platform)
+    try:
+        return stream_rows(client, partial(check_platform_row, platform), **params)
+    except OutputTruncated as e:
+        return e.rows
+    except json.JSONDecodeError:
+        return []
+
+
+def repair_platform_rows(client, platform, batch, checked, complete=True):
+    """Platform rows for batch from its checked output, repairing only the rows that failed.
+
+    With complete, rows the output stopped short of count as failed too. A
+    row whose repair also fails keeps its best-effort values, or is dropped
+    if it had none.
+    """
+    checked = [item if item is not None else (None, ['malformed JSON']) for item in checked]
+    if complete:
+        checked += [(None, ['no output'])] * (len(batch) - len(checked))
+    failed = [i for i, (values, problems) in enumerate(checked) if problems]
+    # Output that can't be matched to rows one-to-one can't be repaired row by row
+    if failed and len(checked) <= len(batch):
+        record(repaired_rows=len(failed))
+        repaired = request_repair(client, platform, [batch[i] for i in failed], [checked[i][1] for i in failed])
+        for i, item in zip(failed, repaired):
+            if item is not None and not item[1]:
+                checked[i] = item
+    for values, problems in checked:
+        if problems:
+            app.logger.warning('%s row kept %s: %s', platform,
+                               'best-effort' if values is not None else 'out', '; '.join(problems))
+    return [values for values, problems in checked]
+
+
+def transform_batch(client, platform, batch, model=MODEL_NAME):
+    """Transform one batch of rows, re-requesting just the rows whose output failed validation.
+
+    Repairs always go to MODEL_NAME, whichever model the batch was sent to.
+    """
+    try:
+        checked = stream_rows(client, partial(check_platform_row, platform), **transform_params(platform, batch, model))
+    except OutputTruncated as e:
+        # Rows after the cut-off are re-sent by split_on_truncation
+        raise OutputTruncated(repair_platform_rows(client, platform, batch, e.rows, complete=False))
+    except json.JSONDecodeError:
+        # No JSON array in the response; every row goes to the repair call
+        checked = []
+    return repair_platform_rows(client, platform, batch, checked)
+
+
+@lru_cache(maxsize=64)
+def detect_input_columns(columns):
+    """Map rule-engine fields to the upload's column names, whatever their naming"""
+    found = {}
+    for field, patterns in INPUT_COLUMN_PATTERNS.items():
+        for pattern in patterns:
+            match = next((c for c in columns if c and re.search(pattern, c.strip(), re.IGNORECASE)), None)
+            if match is not None and match not in found.values():
+                found[field] = match
+                break
+    return found
+
+
+def detect_category(name):
+    """PLATFORM_MAPPINGS category key and taxonomy subcategory for a product name"""
+    lowered = name.lower()
+    weight = extract_weight(name)
+
+    if re.search(r'\b5[ -]?pack\b|multi-?pack', lowered):
+        if 'rosin' in lowered:
+            return 'preroll-infused', '5 Pack Live Rosin-Infused Multipack'
+        if 'hash' in lowered:
+            return 'preroll-infused', '5 Pack Hash-Infused Multipack'
+        return None, None
+    if re.search(r'pre-?rolls?\b|pre rolls?\b|\baltitude\b|\bsubmerge\b', lowered):
+        if 'altitude' in lowered:
+            return 'preroll-infused', 'Altitude Infused Hash Prerolls'
+        if 'submerge' in lowered:
+            return 'preroll-infused', 'Submerge Infused Hash Prerolls'
+        if 'rosin' in lowered:
+            return 'preroll-infused', 'Live Rosin Infused Prerolls'
+        if 'infused' in lowered or 'hash' in lowered:
+            return 'preroll-infused', None
+        return 'preroll-regular', None
+    if re.search(r'all[ -]in[ -]one|\baio\b|disposable', lowered):
+        return 'vape-aio', f'{weight} All-In-One' if weight in ('0.5g', '1g') else None
+    if re.search(r'\b510\b|\bcart(ridge)?s?\b', lowered):
+        return 'vape-510', '510 Vape Cart'
+    if 'rosin' in lowered:
+        return 'rosin', 'Cold Cure Live Rosin' if 'cold cure' in lowered else None
+    if 'hash' in lowered:
+        for subcategory in ('Green Unpressed Hash', 'Orange Unpressed Hash', 'Red Pressed Hash',
+                            'Blue Pressed Hash', 'Onyx Live Pressed Hash'):
+            if subcategory.lower() in lowered:
+                return 'hash', subcategory
+        return 'hash', None
+    if 'flower' in lowered:
+        return 'flower', weight if weight in ('3.5g', '7g', '14g') else None
+    return None, None
+
+
+def conflicting_cues(name):
+    """Whether a product name points at more than one product form, e.g. "Hash Plant Flower" """
+    forms = {form for form, pattern in CATEGORY_CUES.items() if re.search(pattern, name, re.IGNORECASE)}
+    if forms & {'preroll', 'vape'}:
+        forms.discard('concentrate')
+    return len(forms) > 1
+
+
+def extract_genetics(name):
+    """Sativa/Indica/Hybrid from an (S)/(I)/(H) marker in the name"""
+    match = re.search(r'\(\s*([SIH])\s*\)', name, re.IGNORECASE)
+    return {'S': 'Sativa', 'I': 'Indica', 'H': 'Hybrid'}[match.group(1).upper()] if match else ''
+
+
+def extract_weight(name):
+    """Weight from the name; 5 packs are always 2.5g total"""
+    if re.search(r'\b5[ -]?pack\b', name, re.IGNORECASE):
+        return '2.5g'
+    match = re.search(r'(\d*\.?\d+)\s*(?:g|grams?)\b', name, re.IGNORECASE)
+    if not match:
+        return ''
+    value = float(match.group(1))
+    return f'{value:g}g'
+
+
+def clean_strain_name(name, farm=''):
+    """Strain name with genetics marker, weight, product type words and farm removed"""
+    strain = re.sub(r'\(\s*[SIH]\s*\)', ' ', name, flags=re.IGNORECASE)
+    strain = re.sub(r'\b5[ -]?pack\b', ' ', strain, flags=re.IGNORECASE)
+    strain = re.sub(r'(\d*\.?\d+)\s*(?:g|grams?)\b', ' ', strain, flags=re.IGNORECASE)
+    for noise in ([farm] if farm else []) + STRAIN_NOISE:
+        strain = re.sub(r'(?<![\w-])' + re.escape(noise) + r'(?![\w-])', ' ', strain, flags=re.IGNORECASE)
+    strain = ' '.join(strain.split())
+    return strain.strip(' -|,/')
+
+
+def noise_in_strain(name, farm=''):
+    """Whether a product type word or the farm sits before the name's trailing
+    product type, so clean_strain_name would cut it out of the strain itself"""
+    noise = '|'.join(re.escape(word) for word in ([farm] if farm else []) + STRAIN_NOISE)
+    word = r'(?<![\w-])(?:' + noise + r')(?![\w-])'
+    head = re.sub(r'\(\s*[SIH]\s*\)|\b5[ -]?pack\b|(\d*\.?\d+)\s*(?:g|grams?)\b', ' ', name, flags=re.IGNORECASE)
+    head = re.sub(r'(?:[\s|,/-]*' + word + r')+[\s|,/-]*$', '', head, flags=re.IGNORECASE)
+    head = re.sub(r'^\s*(?:' + '|'.join(PRODUCT_LINE_PREFIXES) + r')\b', '', head, flags=re.IGNORECASE)
+    return re.search(word, head, re.IGNORECASE) is not None
+
+
+def slugify(*parts):
+    """Lowercase, hyphenated, URL-safe slug"""
+    text = ' '.join(part for part in parts if part).lower()
+    text = re.sub(r'[^a-z0-9\s-]', '', text)
+    return re.sub(r'[\s-]+', '-', text).strip('-')
+
+
+def parse_description(description):
+    """Split a description into labelled fields and marketing paragraphs.
+
+    Returns None when the description contains a label the engine doesn't know.
+    """
+    fields = {}
+    paragraphs, current = [], []
+    for line in description.replace('\r\n', '\n').split('\n'):
+        stripped = line.strip()
+        label_match = re.match(r'^([A-Z][A-Z ]+):\s*(.*)$', stripped)
+        if label_match:
+            label = label_match.group(1).strip()
+            if label not in DESCRIPTION_LABELS:
+                return None
+            fields[DESCRIPTION_LABELS[label]] = label_match.group(2).strip()
+        elif stripped:
+            current.append(stripped)
+        elif current:
+            paragraphs.append(' '.join(current))
+            current = []
+    if current:
+        paragraphs.append(' '.join(current))
+    fields['marketing'] = paragraphs
+    return fields
+
+
+def parse_product(row):
+    """Product record parsed locally from a row, or None if it can't be parsed with confidence"""
+    columns = detect_input_columns(tuple(k for k in row.keys() if k is not None))
+    value = lambda field: (row.get(columns[field]) or '').strip() if field in columns else ''
+
+    name = value('name')
+    description = parse_description(value('description'))
+    if not name or description is None:
+        return None
+
+    # Separate columns fill anything the description doesn't carry
+    for field in DESCRIPTION_LABELS.values():
+        if not description.get(field):
+            description[field] = value(field)
+
+    category, subcategory = detect_category(name)
+    # A name with mixed cues or a strain made of product words is the model's call
+    if subcategory is None or conflicting_cues(name) or noise_in_strain(name, description['farm']):
+        return None
+    record = {
+        'name': name,
+        'strain': clean_strain_name(name, description['farm']),
+        'genetics': extract_genetics(name),
+        'category': category,
+        'subcategory': subcategory,
+        'weight': extract_weight(name),
+        'thc': description['thc'],
+        'lineage': description['lineage'],
+        'taste': description['taste'],
+        'feeling': description['feeling'],
+        'farm': description['farm'],
+        'place': description['place'],
+        'marketing': description['marketing'],
+        'photo': value('photo'),
+        'batch': value('batch'),
+        'sku': value('sku'),
+    }
+
+    required = ('strain', 'genetics', 'category', 'weight', 'thc', 'lineage', 'taste', 'feeling', 'marketing')
+    if not all(record[field] for field in required) or re.search(r'\bbatch\b', record['strain'], re.IGNORECASE):
+        return None
+    return record
+
+
+def plain_description(record):
+    """THC + LINEAGE + TASTE + FEELING + marketing, without FARM/PLACE GROWN"""
+    lines = [f'{label}: {record[field]}' for label, field in DESCRIPTION_LABELS.items()
+             if field not in ('farm', 'place') and record[field]]
+    return '\n\n'.join(part for part in ['\n'.join(lines)] + record['marketing'] if part)
+
+
+def html_description(record):
+    """Squarespace HTML description keeping every labelled field"""
+    lines = [f'{label}: {record[field]}' for label, field in DESCRIPTION_LABELS.items() if record[field]]
+    paragraphs = ['<br>'.join(lines)] + record['marketing']
+    return ''.join(f'<p class="">{paragraph}</p>' for paragraph in paragraphs if paragraph)
+
+
+def render_platform_row(record, platform):
+    """Platform row values built from a product record, in PLATFORM_COLUMNS order"""
+    category = record['category'] or ''
+    group = category.split('-')[0]
+    label = CATEGORY_LABELS.get(category, '')
+    is_five_pack = record['weight'] == '2.5g' and group == 'preroll'
+
+    if platform == 'weedmaps':
+        values = {
+            'name': record['name'],
+            'categories': PLATFORM_MAPPINGS['weedmaps'].get(category, ''),
+            'description': plain_description(record),
+            'avatar_image': record['photo'],
+            'external_id': record['batch'],
+            'gallery_images': record['photo'],
+            'featured': 'FALSE',
+            'tags': ', '.join(t.strip() for t in re.split(r'[,;/]', record['feeling']) if t.strip()),
+            'thc_percentage': record['thc'].rstrip('%').strip() if record['thc'].endswith('%') else '',
+            'genetics': record['genetics'],
+            'strain': record['strain'],
+            'items_per_pack': '5' if is_five_pack else '1',
+            'weight': record['weight'],
+        }
+    elif platform == 'leafly':
+        values = {
+            'Name': record['name'],
+            'SKU': record['sku'],
+            'Description': plain_description(record),
+            'Category': PLATFORM_MAPPINGS['leafly'].get(group, {}).get('category', ''),
+            'Subcategory': PLATFORM_MAPPINGS['leafly'].get(group, {}).get('subcategory', ''),
+            'Strain': record['strain'],
+            'Country Availability': 'US',
+            'State/Province Availability': 'CA',
+            'Image One URL': record['photo'],
+        }
+    elif platform == 'iheartjane':
+        standard = record['weight'] in ('0.5g', '1g')
+        values = {
+            ' ': 'Nasha',
+            'Strain': record['strain'],
+            'Brand Category': label,
+            'Does this Product Come in Standard Pack Sizes of 0.5g (500mg) or 1g (1000mg)?': 'YES' if standard else 'NO',
+            'Enter Non-Standard Pack Size Here [g]': '' if standard else record['weight'].rstrip('g'),
+            'Lineage': record['lineage'],
+            'Product Name (Internal Use)': ' | '.join(
+                ['Nasha', record['strain'], label, record['weight'], record['genetics']]
+            ),
+            'Product Description': plain_description(record),
+            "IMAGE LINK ONLY (PLEASE ATTACH IMAGES TO EMAIL IF YOU DON'T HAVE A LINK)": record['photo'],
+        }
+    elif platform == 'squarespace':
+        first = record['strain'][:1].lower()
+        values = {
+            'Product Type [Non Editable]': 'PHYSICAL',
+            'Product Page': PLATFORM_MAPPINGS['squarespace'].get(group, ''),
+            'Product URL': slugify(record['strain'], record['farm']),
+            'Title': record['strain'],
+            'Description': html_description(record),
+            'SKU': record['sku'],
+            'Price': '0.00',
+            'Sale Price': '0.00',
+            'On Sale': 'No',
+            'Stock': 'Unlimited',
+            'Categories': f'/{first}' if first.isalpha() else '/category',
+            'Tags': record['farm'],
+            'Weight': '0.0',
+            'Length': '0.0',
+            'Width': '0.0',
+            'Height': '0.0',
+            'Visible': 'Yes',
+            'Hosted Image URLs': record['photo'],
+        }
+    else:
+        raise KeyError(platform)
+
+    return [values.get(col, '') for col in PLATFORM_COLUMNS[platform]]
+
+
+def rule_transform(platform, row):
+    """Platform row produced without a model call, or None if the row needs the model"""
+    if not RULE_ENGINE_ENABLED:
+        return None
+    record = parse_product(row)
+    if record is None or (platform == 'squarespace' and not record['farm']):
+        return None
+    return render_platform_row(record, platform)
+
+
+def row_fields(row):
+    """Fields that can differ between rows sharing a name and description"""
+    columns = detect_input_columns(tuple(k for k in row.keys() if k is not None))
+    value = lambda field: (row.get(columns[field]) or '').strip() if field in columns else ''
+    return {
+        'name': value('name'),
+        'weight': extract_weight(value('name')),
+        'photo': value('photo'),
+        'batch': value('batch'),
+        'sku': value('sku'),
+    }
+
+
+def row_identity(row):
+    """Which catalog entry a row is across uploads: its SKU, else batch number, else normalized name"""
+    fields = row_fields(row)
+    if fields['sku']:
+        return f"sku:{fields['sku']}"
+    if fields['batch']:
+        return f"batch:{fields['batch']}"
+    return 'name:' + ' '.join(fields['name'].lower().split())
+
+
+# Namespaces whose output derives from the batch number in a way fan_out can't
+# fill in (Squarespace preroll URLs like "submerge-batch-28"), so rows only
+# share a result with rows of the same batch
+BATCH_KEYED_NAMESPACES = {'squarespace'}
+
+
+def dedup_key(row, namespace=None):
+    """Name without its weight plus every other field that drives the namespace's output, or None"""
+    columns = detect_input_columns(tuple(k for k in row.keys() if k is not None))
+    if 'name' not in columns:
+        return None
+    name = re.sub(r'(\d*\.?\d+)\s*(?:g|grams?)\b', ' ', row.get(columns['name']) or '', flags=re.IGNORECASE)
+    shared = [' '.join(name.lower().split())]
+    row_specific = ('name', 'photo', 'sku') if namespace in BATCH_KEYED_NAMESPACES else ('name', 'photo', 'batch', 'sku')
+    for field in INPUT_COLUMN_PATTERNS:
+        if field in columns and field not in row_specific:
+            shared.append(' '.join((row.get(columns[field]) or '').split()))
+    return tuple(shared)
+
+
+def swap_weight(value, shared, own):
+    """value with the representative row's weight replaced by this row's"""
+    if not shared['weight'] or not isinstance(value, str):
+        return value
+    pattern = r'(?<![\d.])' + re.escape(shared['weight'][:-1]) + r'\s*g\b'
+    return re.sub(pattern, own['weight'], value)
+
+
+def standard_pack(value, shared, own):
+    """I Heart Jane standard pack size answer for this row's weight"""
+    return 'YES' if own['weight'] in ('0.5g', '1g') else 'NO'
+
+
+def non_standard_pack_size(value, shared, own):
+    """I Heart Jane non-standard pack size for this row's weight"""
+    return '' if own['weight'] in ('0.5g', '1g') else own['weight'].rstrip('g')
+
+
+# Output fields filled from each row's own fields when results are fanned out
+# across rows that differ only in weight, batch, SKU or photo: a row_fields
+# key, or a function of (representative's value, representative's fields, row's fields)
+ROW_SPECIFIC_FIELDS = {
+    'analysis': {'subcategory': swap_weight},
+    'record': {
+        'name': 'name', 'weight': 'weight', 'photo': 'photo', 'batch': 'batch', 'sku': 'sku',
+        'subcategory': swap_weight,
+    },
+    'weedmaps': {
+        'name': 'name', 'weight': 'weight', 'external_id': 'batch',
+        'avatar_image': 'photo', 'gallery_images': 'photo',
+    },
+    'leafly': {'Name': 'name', 'SKU': 'sku', 'Image One URL': 'photo'},
+    'iheartjane': {
+        'Does this Product Come in Standard Pack Sizes of 0.5g (500mg) or 1g (1000mg)?': standard_pack,
+        'Enter Non-Standard Pack Size Here [g]': non_standard_pack_size,
+        'Product Name (Internal Use)': swap_weight,
+        "IMAGE LINK ONLY (PLEASE ATTACH IMAGES TO EMAIL IF YOU DON'T HAVE A LINK)": 'photo',
+    },
+    'squarespace': {'SKU': 'sku', 'Hosted Image URLs': 'photo'},
+}
+
+
+def fan_out(result, namespace, shared_row, row):
+    """Copy of a representative row's result with another group member's own fields"""
+    if result is None or row is shared_row:
+        return result
+    shared, own = row_fields(shared_row), row_fields(row)
+    if isinstance(result, list):
+        # Platform rows are value lists, addressed by column position
+        slots = PLATFORM_COLUMN_INDEX[namespace]
+        result = list(result)
+    else:
+        slots = {field: field for field in result}
+        result = dict(result)
+    for field, source in ROW_SPECIFIC_FIELDS[namespace].items():
+        if field not in slots:
+            continue
+        slot = slots[field]
+        if callable(source):
+            if shared['weight'] != own['weight']:
+                result[slot] = source(result[slot], shared, own)
+        elif shared[source] != own[source]:
+            result[slot] = own[source]
+    return result
+
+
+def parse_taxonomy(taxonomy):
+    """Map each subcategory in the taxonomy text to its analysis main category"""
+    subcategories = {}
+    main_category = None
+    for line in taxonomy.splitlines():
+        heading = re.match(r'^\d+\.\s+(.+?)(?:\s+\(future\))?$', line.strip())
+        if heading:
+            main_category = TAXONOMY_LABELS[heading.group(1)]
+        elif line.strip().startswith('- ') and main_category:
+            subcategory = re.sub(r'\s*\(future\)$', '', line.strip()[2:])
+            subcategories[subcategory] = main_category
+    return subcategories
+
+
+TAXONOMY_SUBCATEGORIES = parse_taxonomy(PRODUCT_TAXONOMY)
+
+
+def classify_product(row):
+    """Analysis object for a row from its name alone, with a 0-1 confidence.
+
+    A taxonomy subcategory written out in the name is certain; one inferred
+    from keywords (Altitude, AIO, a flower weight) is likely; a main category
+    without a subcategory, or one inferred from a name with conflicting
+    cues, is a guess.
+    """
+    name = row_fields(row)['name']
+    category, subcategory = detect_category(name)
+    if subcategory in TAXONOMY_SUBCATEGORIES:
+        analysis = {'main_category': TAXONOMY_SUBCATEGORIES[subcategory],
+                    'subcategory': subcategory, 'type': extract_genetics(name)}
+        if subcategory.lower() in name.lower():
+            return analysis, 1.0
+        # Keywords pointing at two product forms ("Cart Blanche Flower") make the inference a guess
+        return analysis, 0.5 if conflicting_cues(name) else 0.9
+    if category:
+        return {'main_category': CATEGORY_LABELS[category], 'subcategory': 'Unknown',
+                'type': extract_genetics(name)}, 0.5
+    return None, 0.0
+
+
+def row_difficulty(row):
+    """0-3: one point each for a long description, a description without
+    THC, LINEAGE and TASTE lines or columns, and a name the taxonomy can't
+    place with confidence"""
+    columns = detect_input_columns(tuple(k for k in row.keys() if k is not None))
+    value = lambda field: (row.get(columns[field]) or '').strip() if field in columns else ''
+    description = value('description')
+    # Unlike parse_description, a label the rule engine doesn't know doesn't hide the known ones
+    fields = {DESCRIPTION_LABELS[label.strip()]: text.strip()
+              for label, text in re.findall(r'^\s*([A-Z][A-Z ]+):\s*(.*)$', description, re.MULTILINE)
+              if label.strip() in DESCRIPTION_LABELS}
+    structured = all(fields.get(field) or value(field) for field in ('thc', 'lineage', 'taste'))
+    analysis, confidence = classify_product(row)
+    return ((len(description) > LONG_DESCRIPTION_CHARS) + (not structured)
+            + (confidence < CLASSIFIER_MIN_CONFIDENCE))
+
+
+def local_analysis(row):
+    """Analysis object from the local classifier, or None if the row needs the model"""
+    if not RULE_ENGINE_ENABLED:
+        return None
+    analysis, confidence = classify_product(row)
+    return analysis if confidence >= CLASSIFIER_MIN_CONFIDENCE else None
+
+
+class ResultCache:
+    """Persistent SQLite cache of per-row model results with size and age eviction"""
+
+    def __init__(self, path, max_rows=CACHE_MAX_ROWS, max_age_days=CACHE_MAX_AGE_DAYS):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS row_results ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS row_results_accessed ON row_results (accessed_at)'
+            )
+        return self._conn
+
+    def get(self, key):
+        if not self.path:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            found = conn.execute(
+                'SELECT value FROM row_results WHERE key = ? AND created_at >= ?',
+                (key, now - self.max_age)
+            ).fetchone()
+            if found is None:
+                return None
+            conn.execute('UPDATE row_results SET accessed_at = ? WHERE key = ?', (now, key))
+            conn.commit()
+        return json.loads(found[0])
+
+    def put_many(self, items):
+        if not self.path or not items:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                'INSERT OR REPLACE INTO row_results (key, value, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?)',
+                [(key, json.dumps(value), now, now) for key, value in items]
+            )
+            self._writes += len(items)
+            # Evict every few hundred writes rather than on every batch
+            if self._writes >= 500:
+                self._writes = 0
+                self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM row_results WHERE created_at < ?', (now - self.max_age,))
+        excess = conn.execute('SELECT COUNT(*) FROM row_results').fetchone()[0] - self.max_rows
+        if excess > 0:
+            # Least recently used rows go first
+            conn.execute(
+                'DELETE FROM row_results WHERE key IN '
+                '(SELECT key FROM row_results ORDER BY accessed_at LIMIT ?)',
+                (excess,)
+            )
+
+
+result_cache = ResultCache(CACHE_PATH)
+
+
+class CheckpointStore:
+    """Results of completed batches per upload, so a retried transform resumes.
+
+    Entries are keyed by upload digest, platform and row position, and are
+    written one batch at a time.
+    """
+
+    def __init__(self, path, max_age_hours=CHECKPOINT_MAX_AGE_HOURS):
+        self.path = path
+        self.max_age = max_age_hours * 3600
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints ('
+                'upload TEXT NOT NULL, namespace TEXT NOT NULL, row INTEGER NOT NULL, '
+                'value TEXT NOT NULL, created_at REAL NOT NULL, '
+                'PRIMARY KEY (upload, namespace, row))'
+            )
+        return self._conn
+
+    def get(self, upload, namespace, row):
+        if not self.path:
+            return None
+        with self._lock:
+            found = self._connect().execute(
+                'SELECT value FROM checkpoints WHERE upload = ? AND namespace = ? AND row = ? '
+                'AND created_at >= ?',
+                (upload, namespace, row, time.time() - self.max_age)
+            ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def save(self, upload, namespace, items):
+        if not self.path or not items:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                'INSERT OR REPLACE INTO checkpoints (upload, namespace, row, value, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(upload, namespace, row, json.dumps(value), now) for row, value in items]
+            )
+            self._writes += len(items)
+            if self._writes >= 500:
+                self._writes = 0
+                conn.execute('DELETE FROM checkpoints WHERE created_at < ?', (now - self.max_age,))
+            conn.commit()
+
+    def clear(self, upload, namespace):
+        if not self.path:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM checkpoints WHERE upload = ? AND namespace = ?', (upload, namespace))
+            conn.commit()
+
+
+checkpoints = CheckpointStore(CHECKPOINT_PATH)
+
+
+class CatalogStore:
+    """Fingerprint and platform result of every row of a catalog's last upload.
+
+    Rows are keyed by catalog name, platform and row_identity, so the next
+    upload of the catalog can be diffed against them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS catalog_rows ('
+                'catalog TEXT NOT NULL, platform TEXT NOT NULL, identity TEXT NOT NULL, '
+                'fingerprint TEXT NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL, '
+                'PRIMARY KEY (catalog, platform, identity))'
+            )
+        return self._conn
+
+    def fingerprints(self, catalog, platform):
+        """{identity: fingerprint} for the catalog's stored rows"""
+        if not self.path:
+            return {}
+        with self._lock:
+            return dict(self._connect().execute(
+                'SELECT identity, fingerprint FROM catalog_rows WHERE catalog = ? AND platform = ?',
+                (catalog, platform)
+            ))
+
+    def get(self, catalog, platform, identity):
+        if not self.path:
+            return None
+        with self._lock:
+            found = self._connect().execute(
+                'SELECT value FROM catalog_rows WHERE catalog = ? AND platform = ? AND identity = ?',
+                (catalog, platform, identity)
+            ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def put_many(self, catalog, platform, items):
+        """Store (identity, fingerprint, value) rows"""
+        if not self.path or not items:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                'INSERT OR REPLACE INTO catalog_rows (catalog, platform, identity, fingerprint, value, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(catalog, platform, identity, fingerprint, json.dumps(value), now)
+                 for identity, fingerprint, value in items]
+            )
+            conn.commit()
+
+    def remove(self, catalog, platform, identities):
+        if not self.path or not identities:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                'DELETE FROM catalog_rows WHERE catalog = ? AND platform = ? AND identity = ?',
+                [(catalog, platform, identity) for identity in identities]
+            )
+            conn.commit()
+
+
+catalog_store = CatalogStore(CATALOG_PATH)
+
+
+def upload_digest(binary_stream):
+    """SHA-256 of an upload's bytes, leaving the stream rewound for parsing"""
+    digest = hashlib.sha256()
+    binary_stream.seek(0)
+    for chunk in iter(partial(binary_stream.read, 1 << 20), b''):
+        digest.update(chunk)
+    binary_stream.seek(0)
+    return digest.hexdigest()
+
+
+def normalize_row(row):
+    """Row with trimmed keys and whitespace-collapsed values, for stable hashing"""
+    normalized = {}
+    for key, value in row.items():
+        if key is None:
+            continue
+        if isinstance(value, str):
+            value = ' '.join(value.split())
+        normalized[key.strip()] = value if value is not None else ''
+    return normalized
+
+
+def prompt_version(namespace):
+    """Hash of the instruction block (taxonomy, mappings, columns, rules) for a namespace"""
+    if namespace == 'analysis':
+        template = ANALYSIS_INSTRUCTIONS
+    elif namespace == 'record':
+        template = EXTRACTION_INSTRUCTIONS
+    else:
+        template = TRANSFORM_INSTRUCTIONS[namespace]
+    return hashlib.sha256(f'{CACHE_VERSION}:{template}'.encode('utf-8')).hexdigest()
+
+
+def row_cache_key(row, namespace, version, model=MODEL_NAME):
+    """Content address of one input row's result from a model for a platform (or 'analysis')"""
+    payload = json.dumps(
+        [normalize_row(row), namespace, model, version],
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def estimate_tokens(text):
+    """Approximate token count of a piece of text"""
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+# Estimated completion tokens per row of analysis output
+ANALYSIS_ROW_TOKENS = estimate_tokens(
+    '{"main_category": "Preroll", "subcategory": "5 Pack Live Rosin-Infused Multipack", "type": "Hybrid"}, '
+)
+
+
+def estimate_row_tokens(row, namespace):
+    """Estimated (input, output) tokens one row adds to a batch for a namespace"""
+    input_tokens = estimate_tokens(json.dumps(row, indent=2))
+    if namespace == 'analysis':
+        return input_tokens, ANALYSIS_ROW_TOKENS
+    # Output rows restate the row's content under the output's own keys
+    keys = RECORD_FIELDS if namespace == 'record' else PLATFORM_COLUMNS[namespace]
+    content = ''.join(value for value in row.values() if isinstance(value, str))
+    return input_tokens, estimate_tokens(json.dumps(keys)) + estimate_tokens(json.dumps(content))
+
+
+def output_token_budget(namespace):
+    """Estimated completion tokens a batch may use, leaving headroom below max_tokens"""
+    if namespace == 'analysis':
+        max_tokens = ANALYSIS_MAX_TOKENS
+    elif namespace == 'record':
+        max_tokens = EXTRACTION_MAX_TOKENS
+    else:
+        max_tokens = TRANSFORM_MAX_TOKENS
+    return int(max_tokens * BATCH_OUTPUT_FILL)
+
+
+def iter_cache_spans(rows, namespace, resolve_local=None, upload=None):
+    """Group rows into spans whose cache misses fill one model call's token budget.
+
+    Each span is a list of (position, row, key, cached_result) in input
+    order; rows resolved locally, from the upload's checkpoints or from the
+    cache stay in their span so output order is preserved.
+    """
+    version = prompt_version(namespace)
+    output_budget = output_token_budget(namespace)
+    span, groups, input_tokens, output_tokens = [], set(), 0, 0
+    for position, row in enumerate(rows):
+        key = None
+        with stage('rule_engine'):
+            cached = resolve_local(row) if resolve_local else None
+        with stage('cache_lookup'):
+            if cached is None and upload:
+                cached = checkpoints.get(upload, namespace, position)
+            if cached is None:
+                key = row_cache_key(row, namespace, version)
+                cached = result_cache.get(key)
+                if cached is None and row_model(row) != MODEL_NAME:
+                    # A simple row may have been answered by the fast model
+                    cached = result_cache.get(row_cache_key(row, namespace, version, FAST_MODEL))
+            if isinstance(cached, dict) and namespace in PLATFORM_COLUMNS:
+                # Stored before platform rows were kept as value lists
+                cached = pad_platform_row(namespace, cached)
+        group = dedup_key(row, namespace) if cached is None else None
+        if cached is None and (group is None or group not in groups):
+            row_input, row_output = estimate_row_tokens(row, namespace)
+            # Close the span before this row would overflow the call's budget
+            if groups and (input_tokens + row_input > BATCH_INPUT_TOKENS
+                           or output_tokens + row_output > output_budget):
+                yield span
+                span, groups, input_tokens, output_tokens = [], set(), 0, 0
+            # Rows without a dedup key get a group of their own
+            groups.add(group if group is not None else object())
+            input_tokens += row_input
+            output_tokens += row_output
+        # Later rows of a group already in the span ride along for free
+        span.append((position, row, key, cached))
+        if len(groups) >= BATCH_MAX_ROWS or len(span) >= CACHE_SPAN_MAX:
+            yield span
+            span, groups, input_tokens, output_tokens = [], set(), 0, 0
+    if span:
+        yield span
+
+
+def group_misses(misses, namespace=None):
+    """Distinct rows by dedup_key, and for each miss the index of its group's row"""
+    unique, owners, positions = [], [], {}
+    for row in misses:
+        group = dedup_key(row, namespace)
+        if group is None or group not in positions:
+            if group is not None:
+                positions[group] = len(unique)
+            owners.append(len(unique))
+            unique.append(row)
+        else:
+            owners.append(positions[group])
+    return unique, owners
+
+
+def row_model(row):
+    """FAST_MODEL for a row simple enough for it, else MODEL_NAME"""
+    return FAST_MODEL if FAST_MODEL and row_difficulty(row) <= FAST_MAX_DIFFICULTY else MODEL_NAME
+
+
+def call_tiered(namespace, batch_func, batch):
+    """batch_func(batch, model=...) with simple rows on FAST_MODEL and the rest on MODEL_NAME.
+
+    The two calls run at the same time. A simple row the fast model left
+    malformed, out or outside the taxonomy, or every simple row if its output
+    can't be matched to them or its call failed, is escalated to MODEL_NAME. Returns the results
+    and the model that produced each.
+    """
+    def call(model, rows):
+        return split_on_truncation(
+            partial(call_with_deadline, f'{namespace}/{model}', partial(batch_func, model=model)), rows
+        )
+
+    simple = [i for i, row in enumerate(batch) if row_model(row) != MODEL_NAME]
+    if not simple:
+        results = call(MODEL_NAME, batch)
+        return results, [MODEL_NAME] * len(results)
+    results, models = [None] * len(batch), [MODEL_NAME] * len(batch)
+
+    def place(indices, output, model):
+        if len(output) != len(indices):
+            app.logger.warning('%s output for %d rows had %d elements; rows dropped', model, len(indices), len(output))
+            return
+        for i, result in zip(indices, output):
+            results[i], models[i] = result, model
+
+    hard = sorted(set(range(len(batch))) - set(simple))
+    fast, cancelled = start_call(call, FAST_MODEL, [batch[i] for i in simple])
+    try:
+        place(hard, call(MODEL_NAME, [batch[i] for i in hard]) if hard else [], MODEL_NAME)
+        try:
+            fast_output = fast.result()
+        except Exception as e:
+            app.logger.warning('%s call for %d rows failed, escalating them: %s', FAST_MODEL, len(simple), e)
+            fast_output = []
+    finally:
+        cancelled.set()
+    if len(fast_output) == len(simple):
+        place(simple, fast_output, FAST_MODEL)
+    escalated = [i for i in simple if results[i] is None]
+    if escalated:
+        record(escalated_rows=len(escalated))
+        place(escalated, call(MODEL_NAME, [batch[i] for i in escalated]), MODEL_NAME)
+    return results, models
+
+
+def run_cache_span(namespace, batch_func, span, upload=None, positioned=False):
+    """Resolve a span, calling batch_func once per distinct cache miss.
+
+    Misses sharing a dedup_key are sent once and the result fanned out to
+    every member with its own weight, batch, SKU and photo filled in. With
+    an upload digest, the fresh results are checkpointed for that upload.
+    With positioned, each result is returned as (position, result).
+    """
+    misses = [(position, row) for position, row, key, cached in span if cached is None]
+    unique, owners = group_misses([row for position, row in misses], namespace)
+    if unique:
+        record(batches=1)
+    shared, models = call_tiered(namespace, batch_func, unique) if unique else ([], [])
+
+    dropped = []
+    if len(shared) != len(unique):
+        # Model output can't be matched to rows one-to-one; discard it and report every
+        # row sent as failed, so a retry sends them again without duplicating any
+        results = [(position, cached) for position, row, key, cached in span if cached is not None]
+        dropped = [position for position, row in misses]
+        error = f'Model output had {len(shared)} elements'
+    else:
+        fresh = iter([(fan_out(shared[i], namespace, unique[i], row), models[i])
+                      for i, (position, row) in zip(owners, misses)])
+        results, new_entries, completed = [], [], []
+        for position, row, key, cached in span:
+            if cached is None:
+                cached, model = next(fresh)
+                if cached is None:
+                    # Malformed in the response; only this row is lost
+                    dropped.append(position)
+                    continue
+                if model != MODEL_NAME:
+                    # Cached under the model that answered, so it isn't served once that model changes
+                    key = row_cache_key(row, namespace, prompt_version(namespace), model)
+                new_entries.append((key, cached))
+                completed.append((position, cached))
+            results.append((position, cached))
+        result_cache.put_many(new_entries)
+        if upload:
+            checkpoints.save(upload, namespace, completed)
+        error = 'No valid model output'
+    results = results if positioned else [result for position, result in results]
+    if dropped:
+        raise RowsDropped(results, [position + 1 for position in dropped], error)
+    return results
+
+
+DEADLINE_ERROR = 'Request deadline exceeded'
+
+
+class RowsDropped(Exception):
+    """A span that resolved except for some rows, whose model output was unusable.
+
+    results holds the span's results without them; rows are their 1-based numbers.
+    """
+
+    def __init__(self, results, rows, error):
+        super().__init__(f"{error} for {len(rows)} rows")
+        self.results = results
+        self.rows = rows
+
+
+def span_failure(span, error, positioned=False):
+    """A span's already resolved results and a report of its rows, for a span that didn't finish"""
+    resolved = [(position, cached) if positioned else cached
+                for position, row, key, cached in span if cached is not None]
+    return resolved, {'first_row': span[0][0] + 1, 'last_row': span[-1][0] + 1, 'error': error}
+
+
+def run_span_isolated(run, span, positioned=False):
+    """(results, None) from run(span), or on failure the span's already
+    resolved results and a report of the rows that failed"""
+    try:
+        return run(span), None
+    except RowsDropped as e:
+        app.logger.warning('Rows %s dropped: %s', ', '.join(map(str, e.rows)), e)
+        return e.results, {'first_row': e.rows[0], 'last_row': e.rows[-1], 'rows': e.rows, 'error': str(e)}
+    except Exception as e:
+        app.logger.warning('Rows %d-%d failed: %s', span[0][0] + 1, span[-1][0] + 1, e)
+        return span_failure(span, str(e), positioned)
+
+
+class SpanQueue:
+    """Spans waiting to run, in a SQLite table shared by every process using it.
+
+    A pipeline queues its spans under a run ID and reads each span's result
+    back in order; span workers in any process claim and run them. A claim
+    is a lease, so a span whose process died is handed out again.
+    """
+
+    def __init__(self, path, lease_seconds=QUEUE_LEASE_SECONDS):
+        self.path = path
+        self.lease = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS span_queue ('
+                'run TEXT NOT NULL, seq INTEGER NOT NULL, task TEXT NOT NULL, '
+                'status TEXT NOT NULL, result TEXT, leased_until REAL, created_at REAL NOT NULL, '
+                'PRIMARY KEY (run, seq))'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS span_queue_waiting ON span_queue (status, created_at)'
+            )
+        return self._conn
+
+    def put(self, run, seq, task):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO span_queue (run, seq, task, status, created_at) "
+                "VALUES (?, ?, ?, 'pending', ?)",
+                (run, seq, json.dumps(task), time.time())
+            )
+            conn.commit()
+
+    def claim(self, run=None):
+        """Lease the oldest waiting span, of one run if given: (run, seq, task) or None"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            found = conn.execute(
+                "SELECT run, seq, task, status, leased_until FROM span_queue "
+                "WHERE (status = 'pending' OR (status = 'leased' AND leased_until < ?))"
+                + (" AND run = ?" if run else "") + " ORDER BY created_at, seq LIMIT 1",
+                (now, run) if run else (now,)
+            ).fetchone()
+            if found is None:
+                return None
+            run, seq, task, status, leased_until = found
+            # Compare-and-swap so only one process claims each span
+            cursor = conn.execute(
+                "UPDATE span_queue SET status = 'leased', leased_until = ? "
+                "WHERE run = ? AND seq = ? AND status = ? AND leased_until IS ?",
+                (now + self.lease, run, seq, status, leased_until)
+            )
+            conn.commit()
+        return (run, seq, json.loads(task)) if cursor.rowcount else None
+
+    def complete(self, run, seq, result):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE span_queue SET status = 'done', result = ? WHERE run = ? AND seq = ?",
+                (json.dumps(result), run, seq)
+            )
+            conn.commit()
+
+    def result(self, run, seq):
+        """A finished span's result, or None while it is waiting or running"""
+        with self._lock:
+            found = self._connect().execute(
+                "SELECT result FROM span_queue WHERE run = ? AND seq = ? AND status = 'done'", (run, seq)
+            ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def clear(self, run):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM span_queue WHERE run = ?', (run,))
+            conn.commit()
+
+
+span_queue = SpanQueue(QUEUE_PATH)
+# A process's span workers send at most NASHA_QUEUE_WORKERS model requests at once
+queue_call_slots = threading.BoundedSemaphore(max(1, QUEUE_WORKERS))
+
+
+def span_batch_func(client, namespace):
+    """The model call that resolves a namespace's cache misses"""
+    if namespace == 'analysis':
+        return partial(analyze_batch, client)
+    if namespace == 'record':
+        return partial(extract_batch, client)
+    return partial(transform_batch, client, namespace)
+
+
+def run_span_task(client, task):
+    """Run a queued span, returning its results, any failure and its stats"""
+    stats = RequestStats(task['namespace'])
+    slots_token = _call_slots.set(queue_call_slots)
+    try:
+        with tracking(stats):
+            results, failure = run_span_isolated(partial(
+                run_cache_span, task['namespace'], span_batch_func(client, task['namespace']),
+                upload=task['upload'], positioned=task['positioned']
+            ), task['span'], task['positioned'])
+    finally:
+        _call_slots.reset(slots_token)
+    return {'results': results, 'failure': failure, 'stats': stats.as_dict()}
+
+
+def run_queued_span(queue, run=None):
+    """Claim and run one queued span; False if none was waiting"""
+    claimed = queue.claim(run)
+    if claimed is None:
+        return False
+    run, seq, task = claimed
+    queue.complete(run, seq, run_span_task(get_client(), task))
+    return True
+
+
+def dispatch_queued(queue, namespace, spans, upload=None, positioned=False, deadline=None):
+    """Queue spans for the span workers of every process, yielding
+    (results, failure) in span order.
+
+    Only NASHA_QUEUE_WINDOW spans are queued ahead of the results being
+    consumed. While waiting, this thread runs its own spans too, so the run
+    finishes even with no span workers free. Spans not finished by the
+    deadline are reported as failed.
+    """
+    run = uuid.uuid4().hex
+    pending = deque()
+    expired = lambda: deadline is not None and time.monotonic() >= deadline
+
+    def wait(seq, span):
+        while True:
+            result = queue.result(run, seq)
+            if result is not None:
+                # Usage of spans run elsewhere still counts towards this request
+                stats = _current_stats.get()
+                if stats is not None:
+                    stats.merge(result['stats'])
+                return result['results'], result['failure']
+            if expired():
+                return span_failure(span, DEADLINE_ERROR, positioned)
+            if not run_queued_span(queue, run):
+                time.sleep(QUEUE_POLL_SECONDS)
+
+    try:
+        for seq, span in enumerate(spans):
+            if expired():
+                yield span_failure(span, DEADLINE_ERROR, positioned)
+                continue
+            queue.put(run, seq, {'namespace': namespace, 'span': span, 'upload': upload, 'positioned': positioned})
+            pending.append((seq, span))
+            if len(pending) >= max(1, QUEUE_WINDOW):
+                yield wait(*pending.popleft())
+        while pending:
+            yield wait(*pending.popleft())
+    finally:
+        queue.clear(run)
+
+
+def dispatch_spans(client, namespace, spans, upload=None, positioned=False, deadline=None):
+    """Resolve spans with run_cache_span, yielding (results, failure) in span order.
+
+    Spans run on this process's thread pool, or with NASHA_QUEUE_DB set,
+    through the shared span queue. A span that raised is reported as a
+    failure rather than stopping the others, and so is every span not
+    finished by the deadline (a time.monotonic() value).
+    """
+    if QUEUE_PATH:
+        return dispatch_queued(span_queue, namespace, spans, upload, positioned, deadline)
+    # Fast-model, hedged and repair calls share the NASHA_MAX_IN_FLIGHT requests
+    slots = threading.BoundedSemaphore(max(1, MAX_IN_FLIGHT))
+    return dispatch_ordered(
+        partial(limiting_calls, slots, partial(run_span_isolated, partial(
+            run_cache_span, namespace, span_batch_func(client, namespace), upload=upload, positioned=positioned
+        ), positioned=positioned)),
+        spans, deadline=deadline, on_timeout=partial(span_failure, error=DEADLINE_ERROR, positioned=positioned)
+    )
+
+
+def resolved(results, missing=None):
+    """Each span's results from dispatch_spans, aborting at the first failed span.
+
+    With a missing list, spans cut off by the request deadline and rows
+    dropped for unusable model output are reported there instead, and the
+    rest of their span still yielded.
+    """
+    for span_results, failure in results:
+        if failure and missing is not None and (failure['error'] == DEADLINE_ERROR or 'rows' in failure):
+            missing.append(failure)
+        elif failure:
+            raise RuntimeError(f"Rows {failure['first_row']}-{failure['last_row']} failed: {failure['error']}")
+        yield span_results
+
+
+_span_workers_pid = None
+_span_workers_lock = threading.Lock()
+
+
+def serve_span_queue(queue):
+    """Run queued spans forever"""
+    while True:
+        try:
+            if not run_queued_span(queue):
+                time.sleep(QUEUE_POLL_SECONDS)
+        except Exception:
+            app.logger.exception('Span worker failed')
+            time.sleep(QUEUE_POLL_SECONDS)
+
+
+def start_span_workers(threads=QUEUE_WORKERS):
+    """Start this process's span worker threads, once per process"""
+    global _span_workers_pid
+    if not QUEUE_PATH or threads < 1:
+        return
+    with _span_workers_lock:
+        # Threads don't survive a fork, so a forked worker starts its own
+        if _span_workers_pid == os.getpid():
+            return
+        _span_workers_pid = os.getpid()
+        for i in range(threads):
+            threading.Thread(target=serve_span_queue, args=(span_queue,), name=f'nasha-span-{i}', daemon=True).start()
+
+
+def serve_span_workers():
+    """Run this process's span workers until it is killed"""
+    start_span_workers()
+    threading.Event().wait()
+
+
+def analyze_rows(client, rows, on_span=None, deadline=None):
+    """Category counts for rows, analyzing cache misses in concurrent batches.
+
+    Results arrive in row order and are counted as they come rather than
+    held in a list. Rows not analyzed by the deadline are left out of the
+    counts and listed under missing_rows.
+    """
+    rows = CountingIterator(rows)
+    category_counts, missing = {}, []
+    spans = iter_cache_spans(rows, 'analysis', local_analysis)
+
+    for span_analysis in resolved(dispatch_spans(client, 'analysis', spans, deadline=deadline), missing):
+        # Count categories
+        for item in span_analysis:
+            subcategory = item.get('subcategory', 'Unknown')
+            category_counts[subcategory] = category_counts.get(subcategory, 0) + 1
+        if on_span:
+            on_span()
+
+    result = {
+        'total_products': rows.count,
+        'categories': category_counts,
+        'success': True
+    }
+    if missing:
+        result['missing_rows'] = missing
+    return result
+
+
+def drain(buffer):
+    """Contents of a StringIO buffer, emptying it for reuse"""
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return value
+
+
+def iter_transformed_csv(client, platform, rows, upload=None, on_failure=None, deadline=None, on_deadline=None):
+    """Yield the platform CSV in chunks: the header, then each span's rows in order.
+
+    Rows the rule engine can't parse and cache misses go to the model in
+    concurrent batches, reassembled in original row order. With an upload
+    digest, completed batches are checkpointed and a retry of the same
+    upload skips them. A failed batch doesn't stop the others: its rows are
+    left out and reported to on_failure, or without one the stream is
+    aborted at the end; so are the rows not finished by the deadline,
+    unless on_deadline takes over the failures and the stream ends cleanly.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(PLATFORM_COLUMNS[platform])
+    yield drain(buffer)
+
+    spans = iter_cache_spans(rows, platform, partial(rule_transform, platform), upload)
+    failures = []
+    try:
+        for batch, (span_transformed, failure) in enumerate(
+                dispatch_spans(client, platform, spans, upload, deadline=deadline), 1):
+            with stage('csv_write'):
+                writer.writerows(span_transformed)
+            if failure:
+                failure['batch'] = batch
+                failures.append(failure)
+                if on_failure:
+                    on_failure(failure)
+            yield drain(buffer)
+        if failures and on_failure is None:
+            if on_deadline and any(f['error'] == DEADLINE_ERROR for f in failures):
+                on_deadline(failures)
+                return
+            raise RuntimeError(
+                f'{len(failures)} batches failed: ' +
+                ', '.join(f"rows {f['first_row']}-{f['last_row']}" for f in failures)
+            )
+    except Exception:
+        # Headers are already sent; log and abort the chunked body so the
+        # client sees a failed download rather than a silently truncated CSV
+        app.logger.exception('Transform to %s failed mid-stream', platform)
+        raise
+    if upload and not failures:
+        checkpoints.clear(upload, platform)
+
+
+DELTA_MODES = ('full', 'changes')
+
+
+def iter_delta_csv(client, platform, rows, catalog, mode='full', deadline=None):
+    """Yield the platform CSV of an upload diffed against the catalog's last upload.
+
+    Rows are matched by row_identity and compared by fingerprint. Only added
+    and changed rows are transformed; unchanged rows reuse their stored
+    result. In 'full' mode every row of the upload is written; in 'changes'
+    mode only added, changed and removed rows, with a leading Change column
+    saying which. The stored catalog is only updated once every batch has
+    succeeded, so a failed run can simply be repeated; the result cache
+    keeps the repeat cheap.
+    """
+    counts = dict.fromkeys(('added', 'changed', 'unchanged', 'removed'), 0)
+    changes_only = mode == 'changes'
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow((['Change'] if changes_only else []) + PLATFORM_COLUMNS[platform])
+    yield drain(buffer)
+
+    previous = catalog_store.fingerprints(catalog, platform)
+    version = prompt_version(platform)
+    occurrences, entries, stored = {}, {}, {}
+    # Positions as iter_cache_spans numbers the rows diffed() yields
+    positions = count()
+
+    def diffed(rows):
+        for row in rows:
+            identity = row_identity(row)
+            occurrences[identity] = occurrences.get(identity, 0) + 1
+            if occurrences[identity] > 1:
+                # Rows sharing an identity are told apart by their order
+                identity = f'{identity}#{occurrences[identity]}'
+            fingerprint = row_cache_key(row, platform, version)
+            value = catalog_store.get(catalog, platform, identity) if previous.get(identity) == fingerprint else None
+            status = 'unchanged' if value is not None else 'changed' if identity in previous else 'added'
+            counts[status] += 1
+            if status == 'unchanged':
+                if changes_only:
+                    continue
+                stored[id(row)] = value
+            entries[next(positions)] = (identity, fingerprint, status)
+            yield row
+
+    resolve_local = lambda row: stored.pop(id(row), None) or rule_transform(platform, row)
+    # Positions depend on the stored catalog, so there are no per-upload checkpoints
+    spans = iter_cache_spans(diffed(rows), platform, resolve_local)
+    failures, changed = [], []
+    try:
+        for span_transformed, failure in dispatch_spans(client, platform, spans, positioned=True, deadline=deadline):
+            with stage('csv_write'):
+                for position, value in span_transformed:
+                    identity, fingerprint, status = entries.pop(position)
+                    if status != 'unchanged':
+                        changed.append((identity, fingerprint, value))
+                    writer.writerow([status, *value] if changes_only else value)
+            if failure:
+                failures.append(failure)
+            yield drain(buffer)
+        if failures:
+            raise RuntimeError(
+                f'{len(failures)} batches failed: ' +
+                ', '.join(f"rows {f['first_row']}-{f['last_row']}" for f in failures)
+            )
+    except Exception:
+        app.logger.exception('Delta transform to %s failed mid-stream', platform)
+        raise
+    seen = set(occurrences)
+    seen.update(f'{identity}#{i}' for identity, n in occurrences.items() for i in range(2, n + 1))
+    removed = [identity for identity in previous if identity not in seen]
+    counts['removed'] = len(removed)
+    app.logger.info('Delta of catalog %s for %s: %s', catalog, platform,
+                    ', '.join(f'{n} {status}' for status, n in counts.items()))
+    if changes_only:
+        with stage('csv_write'):
+            for identity in removed:
+                value = catalog_store.get(catalog, platform, identity)
+                if value is not None:
+                    writer.writerow(['removed', *value])
+        yield drain(buffer)
+    catalog_store.put_many(catalog, platform, changed)
+    catalog_store.remove(catalog, platform, removed)
+
+
+class MessageBatchBackend:
+    """Message Batches API calls used by offline transforms.
+
+    Kept behind this small interface so a stub can stand in for the API;
+    the client itself honours ANTHROPIC_BASE_URL for a local stub server.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, requests):
+        """Create a message batch, returning its ID"""
+        return with_backoff(partial(self.client.beta.messages.batches.create, requests=requests)).id
+
+    def status(self, batch_id):
+        """Processing status: in_progress, canceling or ended"""
+        return with_backoff(partial(self.client.beta.messages.batches.retrieve, batch_id)).processing_status
+
+    def results(self, batch_id):
+        """(custom_id, message) per request; message is None unless it succeeded"""
+        for entry in with_backoff(partial(self.client.beta.messages.batches.results, batch_id)):
+            yield entry.custom_id, entry.result.message if entry.result.type == 'succeeded' else None
+
+
+def message_rows(message):
+    """Elements of a finished message's JSON array; a cut-off array keeps its complete rows"""
+    text = message.content[0].text
+    parser = JsonArrayParser()
+    elements = parser.feed(text)
+    if not parser.started:
+        try:
+            elements = parse_json_array(text)
+        except ValueError:
+            elements = []
+    return elements
+
+
+def submit_message_batch(backend, platform, path, upload):
+    """Submit every model-bound row of an upload as one message batch.
+
+    Returns the plan: the batch ID and, per request, each sent row's
+    position plus the positions and rows it is fanned out to.
+    """
+    requests, plan = [], {}
+    with open(path, 'rb') as f:
+        spans = iter_cache_spans(iter_upload_rows(f), platform, partial(rule_transform, platform), upload)
+        for index, span in enumerate(spans):
+            misses = [(position, row) for position, row, key, cached in span if cached is None]
+            if not misses:
+                continue
+            unique, owners = group_misses([row for position, row in misses], platform)
+            custom_id = f'span-{index}'
+            groups = [{'row': row, 'members': []} for row in unique]
+            for owner, (position, row) in zip(owners, misses):
+                groups[owner]['members'].append([position, row])
+            requests.append({'custom_id': custom_id, 'params': transform_params(platform, unique)})
+            plan[custom_id] = groups
+    return {'batch_id': backend.submit(requests) if requests else None, 'requests': plan}
+
+
+def checkpoint_message_batch(backend, platform, upload, plan):
+    """Checkpoint and cache each row of a finished message batch.
+
+    Rows whose request failed or whose output was malformed or failed the
+    platform schema are left out; the transform that follows sends them to
+    the model directly.
+    """
+    version = prompt_version(platform)
+    for custom_id, message in backend.results(plan['batch_id']):
+        groups = plan['requests'].get(custom_id)
+        if message is None or groups is None:
+            app.logger.warning('Message batch request %s returned no result', custom_id)
+            continue
+        record_usage(message.model, message.usage, MESSAGE_BATCH_DISCOUNT)
+        completed, new_entries = [], []
+        for group, element in zip(groups, message_rows(message)):
+            result, problems = check_platform_row(platform, element)
+            if problems:
+                continue
+            for position, row in group['members']:
+                member_result = fan_out(result, platform, group['row'], row)
+                completed.append((position, member_result))
+                new_entries.append((row_cache_key(row, platform, version), member_result))
+        checkpoints.save(upload, platform, completed)
+        result_cache.put_many(new_entries)
+
+
+def run_message_batch_transform(client, platform, path, output_path, on_status=None, backend=None):
+    """Transform an upload through the Message Batches API and write the platform CSV.
+
+    The batch ID is saved under JOB_DIR, keyed by upload digest and
+    platform, so a rerun after a restart polls the same batch instead of
+    submitting again. Returns the failed batches of the final pass.
+    """
+    if not CHECKPOINT_PATH:
+        raise RuntimeError('Message batch mode needs NASHA_CHECKPOINT_PATH')
+    backend = backend or MessageBatchBackend(client)
+    with open(path, 'rb') as f:
+        upload = upload_digest(f)
+
+    os.makedirs(JOB_DIR, exist_ok=True)
+    plan_path = os.path.join(JOB_DIR, f'batch-{upload[:16]}-{platform}.json')
+    if os.path.exists(plan_path):
+        with open(plan_path, encoding='utf-8') as f:
+            plan = json.load(f)
+    else:
+        plan = submit_message_batch(backend, platform, path, upload)
+        with open(plan_path, 'w', encoding='utf-8') as f:
+            json.dump(plan, f)
+
+    if plan['batch_id']:
+        while True:
+            status = backend.status(plan['batch_id'])
+            if on_status:
+                on_status(plan['batch_id'], status)
+            if status == 'ended':
+                break
+            time.sleep(MESSAGE_BATCH_POLL_SECONDS)
+        checkpoint_message_batch(backend, platform, upload, plan)
+
+    # Every row is now local, checkpointed or cached; anything missing goes to the model
+    failures = []
+    with open(path, 'rb') as f, open(output_path, 'w', encoding='utf-8', newline='') as out:
+        for chunk in iter_transformed_csv(client, platform, iter_upload_rows(f), upload, failures.append):
+            out.write(chunk)
+    os.remove(plan_path)
+    return failures
+
+
+class JobLeaseLost(Exception):
+    """Another process has taken over a job whose lease this one let run out"""
+
+
+class JobStore:
+    """Background transform/analyze jobs, optionally mirrored to SQLite.
+
+    Uploads and outputs live under JOB_DIR. With a database path set, job
+    state is shared by every process using it and unfinished jobs are picked
+    up again after a restart. Each job is owned by the store running it,
+    which renews its lease while it runs; only jobs whose lease has run out
+    are resumed elsewhere.
+    """
+
+    COLUMNS = [
+        'id', 'kind', 'platform', 'status', 'batches_done', 'batches_total',
+        'rows_total', 'error', 'result', 'upload_path', 'output_path',
+        'created_at', 'updated_at', 'owner', 'lease_until'
+    ]
+
+    def __init__(self, directory, db_path='', workers=JOB_WORKERS, lease_seconds=JOB_LEASE_SECONDS):
+        self.directory = directory
+        self.db_path = db_path
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._executor = None
+        self._heartbeat = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, kind TEXT, platform TEXT, status TEXT, '
+                'batches_done INTEGER, batches_total INTEGER, rows_total INTEGER, '
+                'error TEXT, result TEXT, upload_path TEXT, output_path TEXT, '
+                'created_at REAL, updated_at REAL, owner TEXT, lease_until REAL)'
+            )
+            existing = {row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')}
+            # Tables created before jobs had owners
+            for column, kind in (('owner', 'TEXT'), ('lease_until', 'REAL')):
+                if column not in existing:
+                    self._conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {kind}')
+        return self._conn
+
+    def _save(self, job):
+        if not self.db_path:
+            self._jobs[job['id']] = job
+            return
+        values = dict(job, result=json.dumps(job['result']))
+        self._db().execute(
+            f'INSERT OR REPLACE INTO jobs ({", ".join(self.COLUMNS)}) '
+            f'VALUES ({", ".join("?" for _ in self.COLUMNS)})',
+            [values[c] for c in self.COLUMNS]
+        )
+        self._db().commit()
+
+    def _load(self, row):
+        job = dict(zip(self.COLUMNS, row))
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def _fetch(self, job_id):
+        if not self.db_path:
+            return self._jobs.get(job_id)
+        found = self._db().execute(
+            f'SELECT {", ".join(self.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        return self._load(found) if found else None
+
+    def _submit(self, job_id):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='nasha-job')
+        if self.db_path and self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._renew_leases, name='nasha-job-lease', daemon=True)
+            self._heartbeat.start()
+        self._executor.submit(run_job, self, job_id)
+
+    def _renew_leases(self):
+        """Keep extending the lease on every unfinished job this store owns"""
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                with self._lock:
+                    self._db().execute(
+                        "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                        (time.time() + self.lease_seconds, self.owner)
+                    )
+                    self._db().commit()
+            except sqlite3.Error:
+                app.logger.exception('Renewing job leases failed')
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._fetch(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, **changes):
+        """Change a job this store owns; raises JobLeaseLost if another process took it over"""
+        with self._lock:
+            job = self._fetch(job_id)
+            if job['owner'] != self.owner:
+                raise JobLeaseLost(f'Job {job_id} was taken over by another process')
+            now = time.time()
+            job.update(changes, updated_at=now, lease_until=now + self.lease_seconds)
+            self._save(job)
+
+    def create(self, kind, file, platform=None, job_id=None):
+        """Save the upload and queue a job for it"""
+        self.cleanup()
+        os.makedirs(self.directory, exist_ok=True)
+        job_id = job_id or uuid.uuid4().hex
+        upload_path = os.path.join(self.directory, f'{job_id}.upload.csv')
+        file.stream.seek(0)
+        file.save(upload_path)
+
+        now = time.time()
+        job = {
+            'id': job_id, 'kind': kind, 'platform': platform, 'status': 'queued',
+            'batches_done': 0, 'batches_total': None, 'rows_total': None,
+            'error': None, 'result': None, 'upload_path': upload_path,
+            'output_path': None, 'created_at': now, 'updated_at': now,
+            'owner': self.owner, 'lease_until': now + self.lease_seconds,
+        }
+        with self._lock:
+            self._save(job)
+        self._submit(job_id)
+        return job
+
+    def resume(self):
+        """Re-queue unfinished jobs whose owner's lease has run out"""
+        if not self.db_path:
+            return
+        with self._lock:
+            now = time.time()
+            unfinished = self._db().execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') "
+                "AND (lease_until IS NULL OR lease_until < ?)", (now,)
+            ).fetchall()
+            claimed = []
+            for job_id, in unfinished:
+                # The lease check is repeated in the update so only one process picks each job up
+                cursor = self._db().execute(
+                    "UPDATE jobs SET status = 'queued', batches_done = 0, updated_at = ?, "
+                    "owner = ?, lease_until = ? "
+                    "WHERE id = ? AND status IN ('queued', 'running') "
+                    "AND (lease_until IS NULL OR lease_until < ?)",
+                    (now, self.owner, now + self.lease_seconds, job_id, now)
+                )
+                if cursor.rowcount:
+                    claimed.append(job_id)
+            self._db().commit()
+        for job_id in claimed:
+            self._submit(job_id)
+
+    def cleanup(self):
+        """Forget finished jobs older than JOB_TTL_HOURS and delete their files"""
+        cutoff = time.time() - JOB_TTL_HOURS * 3600
+        with self._lock:
+            if self.db_path:
+                expired = [self._load(row) for row in self._db().execute(
+                    f"SELECT {', '.join(self.COLUMNS)} FROM jobs "
+                    "WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,)
+                )]
+                self._db().execute(
+                    "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,)
+                )
+                self._db().commit()
+            else:
+                expired = [job for job in self._jobs.values()
+                           if job['status'] in ('done', 'failed') and job['updated_at'] < cutoff]
+            for job in expired:
+                self._jobs.pop(job['id'], None)
+                for path in (job['upload_path'], job['output_path']):
+                    if path and os.path.exists(path):
+                        os.remove(path)
+
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+
+def get_job_store():
+    """Process-wide JobStore, resuming unfinished persisted jobs on first use"""
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            _job_store = JobStore(JOB_DIR, JOB_DB_PATH)
+            _job_store.resume()
+        return _job_store
+
+
+def count_spans(path, namespace, resolve_local=None, upload=None):
+    """Rows and spans an upload will be processed in, for progress reporting"""
+    # A pre-pass, so it isn't counted in the job's stats
+    with tracking(None), open(path, 'rb') as f:
+        rows = CountingIterator(iter_upload_rows(f))
+        spans = sum(1 for _ in iter_cache_spans(rows, namespace, resolve_local, upload))
+    return rows.count, spans
+
+
+def run_job(store, job_id):
+    """Run a queued job to completion, recording progress as each span finishes"""
+    job = store.get(job_id)
+    stats = RequestStats(f"{job['kind']}_job", job['platform'])
+    try:
+        client = get_client()
+        progress = count(1)
+        on_span = lambda: store.update(job_id, batches_done=next(progress))
+
+        if job['kind'] == 'analyze':
+            rows_total, batches_total = count_spans(job['upload_path'], 'analysis', local_analysis)
+            store.update(job_id, status='running', rows_total=rows_total, batches_total=batches_total)
+            with tracking(stats), open(job['upload_path'], 'rb') as f:
+                result = analyze_rows(client, iter_upload_rows(f), on_span)
+            store.update(job_id, status='done', result=dict(result, metrics=stats.as_dict()))
+        elif job['kind'] == 'batch':
+            platform = job['platform']
+            output_path = os.path.join(store.directory, f'{job_id}.{platform}.csv')
+            on_status = lambda batch_id, status: store.update(
+                job_id, status='running', result={'batch_id': batch_id, 'batch_status': status}
+            )
+            with tracking(stats):
+                failures = run_message_batch_transform(client, platform, job['upload_path'], output_path, on_status)
+            store.update(job_id, status='done', output_path=output_path,
+                         result={'failed_batches': failures, 'metrics': stats.as_dict()})
+        else:
+            platform = job['platform']
+            with open(job['upload_path'], 'rb') as f:
+                upload = upload_digest(f)
+            rows_total, batches_total = count_spans(
+                job['upload_path'], platform, partial(rule_transform, platform), upload
+            )
+            store.update(job_id, status='running', rows_total=rows_total, batches_total=batches_total)
+            output_path = os.path.join(store.directory, f'{job_id}.{platform}.csv')
+            failures = []
+
+            def on_failure(failure):
+                failures.append(failure)
+                store.update(job_id, result={'failed_batches': failures})
+
+            with tracking(stats), open(job['upload_path'], 'rb') as f, \
+                    open(output_path, 'w', encoding='utf-8', newline='') as out:
+                chunks = iter_transformed_csv(client, platform, iter_upload_rows(f), upload, on_failure)
+                # The first chunk is the header; every later chunk is one span
+                out.write(next(chunks))
+                for chunk in chunks:
+                    out.write(chunk)
+                    on_span()
+            store.update(job_id, status='done', output_path=output_path,
+                         result={'failed_batches': failures, 'metrics': stats.as_dict()})
+    except JobLeaseLost:
+        app.logger.warning('Job %s lost its lease and was stopped', job_id)
+    except Exception as e:
+        app.logger.exception('Job %s failed', job_id)
+        store.update(job_id, status='failed', error=str(e))
+    finally:
+        stats.finish()
+
+
+def wants_background_job():
+    """Whether the client asked for the request to run as a background job"""
+    value = request.values.get('async', '')
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def wants_continuation():
+    """Whether the client asked for a /transform cut short by the deadline to carry on as a job"""
+    value = request.values.get('continue', '')
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def submit_job(kind, file, platform=None):
+    """Queue a background job for the upload and return its ID straight away"""
+    job = get_job_store().create(kind, file, platform)
+    return jsonify({
+        'job_id': job['id'],
+        'status_url': f"/jobs/{job['id']}",
+        'download_url': f"/jobs/{job['id']}/download" if kind in ('transform', 'batch') else None,
+        'success': True
+    }), 202
+
+
+def job_status(job):
+    """Public view of a job"""
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'platform': job['platform'],
+        'status': job['status'],
+        'batches_done': job['batches_done'],
+        'batches_total': job['batches_total'],
+        'rows_total': job['rows_total'],
+        'error': job['error'],
+        'result': job['result'],
+    }
+
+
+# Routes whose stage timings and model usage are tracked
+TRACKED_ENDPOINTS = {'analyze', 'transform', 'export', 'bulk'}
+
+
+@app.before_request
+def ensure_span_workers():
+    # Covers workers forked after the app was imported, e.g. gunicorn --preload
+    start_span_workers()
+
+
+def request_deadline():
+    """time.monotonic() by which a synchronous request stops waiting for batches, or None"""
+    return g.stats.started + REQUEST_DEADLINE if REQUEST_DEADLINE else None
+
+
+@app.before_request
+def start_request_stats():
+    if request.endpoint in TRACKED_ENDPOINTS:
+        platform = request.form.get('platform') if request.endpoint == 'transform' else None
+        # Only known platforms become label values, so a form field can't add series
+        if platform not in PLATFORM_COLUMNS:
+            platform = None
+        g.stats = RequestStats(request.endpoint, platform)
+        g.stats_token = _current_stats.set(g.stats)
+
+
+@app.after_request
+def add_request_stats(response):
+    """Finish the request's stats and send them as headers, unless the body streams"""
+    stats = g.get('stats')
+    if stats is not None and not g.get('stats_streamed'):
+        stats.finish()
+        response.headers.update(stats.headers())
+    return response
+
+
+@app.teardown_request
+def end_request_stats(error=None):
+    token = g.pop('stats_token', None)
+    if token is not None:
+        _current_stats.reset(token)
+
+
+@app.route('/')
+def index():
+    return render_template_string(HTML_TEMPLATE)
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    """AI analyzes the uploaded CSV and categorizes all products"""
+    try:
+        file = request.files['file']
+        
+        # Stream rows from the upload instead of reading it all into memory
+        first_row, rows = peek_rows(iter_upload_rows(file.stream))
+        
+        if first_row is None:
+            return jsonify({'error': 'No data found in CSV'}), 400
+        
+        # Get API key
+        api_key = os.environ.get('ANTHROPIC_API_KEY')
+        if not api_key:
+            return jsonify({'error': 'ANTHROPIC_API_KEY not set'}), 500
+        
+        if wants_background_job():
+            return submit_job('analyze', file)
+        
+        client = get_client()
+        
+        return jsonify(analyze_rows(client, rows, deadline=request_deadline()))
+        
+    except Exception as e:
+        import traceback
+        return jsonify({
+            'error': str(e), 
+            'details': traceback.format_exc()
+        }), 500
+
+@app.route('/transform', methods=['POST'])
+def transform():
+    """Transform CSV to platform format using AI"""
+    try:
+        file = request.files['file']
+        platform = request.form['platform']
+        delta = request.form.get('delta', '')
+        
+        if platform not in PLATFORM_COLUMNS:
+            return jsonify({'error': f'Unknown platform: {platform}'}), 400
+        
+        if delta and delta not in DELTA_MODES:
+            return jsonify({'error': f'Unknown delta mode: {delta}'}), 400
+        
+        if delta and wants_background_job():
+            return jsonify({'error': 'Delta transforms run synchronously only'}), 400
+        
+        # Completed batches are checkpointed against the upload's digest, so
+        # retrying the same file after a failure picks up where it stopped
+        upload = upload_digest(file.stream)
+        
+        # Stream rows from the upload instead of reading it all into memory
+        first_row, rows = peek_rows(iter_upload_rows(file.stream))
+        
+        if first_row is None:
+            return jsonify({'error': 'No data transformed'}), 500
+        
+        # Get API key
+        api_key = os.environ.get('ANTHROPIC_API_KEY')
+        if not api_key:
+            return jsonify({'error': 'ANTHROPIC_API_KEY not set'}), 500
+        
+        if wants_background_job():
+            return submit_job('transform', file, platform)
+        
+        client = get_client()
+        
+        # Send the header straight away, then each batch's rows as it completes;
+        # stats can't go in headers, so they're finished when the body is
+        g.stats_streamed = True
+        headers = {'Content-Disposition': f'attachment; filename=Nasha_{platform}.csv'}
+        if delta:
+            # Only rows added or changed since the catalog's last upload are transformed
+            chunks = iter_delta_csv(client, platform, rows, request.form.get('catalog') or 'default', delta,
+                                    request_deadline())
+        elif wants_continuation():
+            # Named up front, since headers go out first; the job only exists
+            # if the deadline cuts the download short
+            continuation = uuid.uuid4().hex
+            headers['X-Nasha-Continuation-Job'] = continuation
+
+            def continue_as_job(failures):
+                # The job skips every batch checkpointed so far
+                app.logger.warning('Transform to %s hit the request deadline with %d batches left; '
+                                   'continuing as job %s', platform, len(failures), continuation)
+                get_job_store().create('transform', file, platform, continuation)
+
+            chunks = iter_transformed_csv(client, platform, rows, upload, deadline=request_deadline(),
+                                          on_deadline=continue_as_job)
+        else:
+            # Without a continuation the deadline aborts the download, rather than truncating it
+            chunks = iter_transformed_csv(client, platform, rows, upload, deadline=request_deadline())
+        return Response(
+            stream_with_context(iter_tracked(g.stats, chunks)),
+            mimetype='text/csv',
+            headers=headers
+        )
+        
+    except Exception as e:
+        import traceback
+        return jsonify({
+            'error': str(e),
+            'details': traceback.format_exc()
+        }), 500
+
+@app.route('/export', methods=['POST'])
+def export():
+    """Extract each product once and render every platform CSV from it, as a zip"""
+    try:
+        file = request.files['file']
+        platforms = request.form.getlist('platform') or list(PLATFORM_COLUMNS)
+        
+        unknown = [p for p in platforms if p not in PLATFORM_COLUMNS]
+        if unknown:
+            return jsonify({'error': f'Unknown platform: {", ".join(unknown)}'}), 400
+        
+        # Stream rows from the upload instead of reading it all into memory
+        first_row, rows = peek_rows(iter_upload_rows(file.stream))
+        
+        if first_row is None:
+            return jsonify({'error': 'No data found in CSV'}), 400
+        
+        # Get API key
+        api_key = os.environ.get('ANTHROPIC_API_KEY')
+        if not api_key:
+            return jsonify({'error': 'ANTHROPIC_API_KEY not set'}), 500
+        
+        client = get_client()
+        
+        # One record per row: parsed locally where possible, else extracted by the model
+        spans = iter_cache_spans(rows, 'record', parse_product if RULE_ENGINE_ENABLED else None)
+        missing = []
+        results = resolved(dispatch_spans(client, 'record', spans, deadline=request_deadline()), missing)
+        records = (record for span_records in results for record in span_records)
+        
+        return send_file(
+            render_export_zip(records, platforms, missing),
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name='Nasha_all_platforms.zip'
+        )
+        
+    except Exception as e:
+        import traceback
+        return jsonify({
+            'error': str(e),
+            'details': traceback.format_exc()
+        }), 500
+
+@app.route('/bulk', methods=['POST'])
+def bulk():
+    """Run several CSVs, or a zip of them, through one pipeline into a zip of platform CSVs"""
+    try:
+        files = [f for f in request.files.getlist('file') if f.filename]
+        platforms = request.form.getlist('platform') or list(PLATFORM_COLUMNS)
+        layout = request.form.get('layout', 'merged')
+        
+        if not files:
+            return jsonify({'error': 'No files uploaded'}), 400
+        
+        unknown = [p for p in platforms if p not in PLATFORM_COLUMNS]
+        if unknown:
+            return jsonify({'error': f'Unknown platform: {", ".join(unknown)}'}), 400
+        
+        if layout not in ('merged', 'per_file'):
+            return jsonify({'error': f'Unknown layout: {layout}'}), 400
+        
+        # Every file feeds one row stream, so batches pack across file boundaries
+        names, starts = [], []
+        first_row, rows = peek_rows(iter_bulk_rows(files, names, starts))
+        
+        if first_row is None:
+            return jsonify({'error': 'No data found in CSV'}), 400
+        
+        if not os.environ.get('ANTHROPIC_API_KEY'):
+            return jsonify({'error': 'ANTHROPIC_API_KEY not set'}), 500
+        
+        client = get_client()
+        
+        spans = iter_cache_spans(rows, 'record', parse_product if RULE_ENGINE_ENABLED else None)
+        missing = []
+        results = resolved(dispatch_spans(client, 'record', spans, positioned=True, deadline=request_deadline()), missing)
+        records = ((bisect_right(starts, position) - 1, product)
+                   for span_records in results for position, product in span_records)
+        
+        if layout == 'merged':
+            archive = render_zip(records, platforms, lambda key, platform: f'Nasha_{platform}.csv', lambda: [None], missing)
+        else:
+            archive = render_zip(records, platforms, lambda key, platform: f'{names[key]}/Nasha_{platform}.csv',
+                                 lambda: range(len(names)), missing)
+        
+        return send_file(
+            archive,
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name='Nasha_bulk.zip'
+        )
+        
+    except zipfile.BadZipFile as e:
+        return jsonify({'error': f'Invalid zip archive: {e}'}), 400
+    except Exception as e:
+        import traceback
+        return jsonify({
+            'error': str(e),
+            'details': traceback.format_exc()
+        }), 500
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Queue an offline transform through the Message Batches API"""
+    try:
+        file = request.files['file']
+        platform = request.form['platform']
+        
+        if platform not in PLATFORM_COLUMNS:
+            return jsonify({'error': f'Unknown platform: {platform}'}), 400
+        
+        first_row, rows = peek_rows(iter_upload_rows(file.stream))
+        
+        if first_row is None:
+            return jsonify({'error': 'No data found in CSV'}), 400
+        
+        if not os.environ.get('ANTHROPIC_API_KEY'):
+            return jsonify({'error': 'ANTHROPIC_API_KEY not set'}), 500
+        
+        # Batches can take hours, so this always runs as a background job
+        return submit_job('batch', file, platform)
+        
+    except Exception as e:
+        import traceback
+        return jsonify({
+            'error': str(e),
+            'details': traceback.format_exc()
+        }), 500
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus-style counters for this process"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Progress of a background job"""
+    job = get_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<job_id>/download')
+def download_job(job_id):
+    """Finished CSV of a background transform job"""
+    job = get_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['kind'] not in ('transform', 'batch'):
+        return jsonify({'error': 'Only transform jobs produce a download'}), 400
+    if job['status'] != 'done':
+        return jsonify({'error': f"Job is {job['status']}", **job_status(job)}), 409
+    return send_file(
+        os.path.abspath(job['output_path']),
+        mimetype='text/csv',
+        as_attachment=True,
+        download_name=f"Nasha_{job['platform']}.csv"
+    )
+
+def batch_cli(argv):
+    """python app.py batch <csv> <platform> [-o output.csv]"""
+    import argparse
+    parser = argparse.ArgumentParser(prog='app.py batch', description='Transform a CSV offline through the Message Batches API')
+    parser.add_argument('csv', help='Master CSV to transform')
+    parser.add_argument('platform', choices=list(PLATFORM_COLUMNS))
+    parser.add_argument('-o', '--output', help='Output CSV (default: Nasha_<platform>.csv)')
+    args = parser.parse_args(argv)
+
+    output = args.output or f'Nasha_{args.platform}.csv'
+    on_status = lambda batch_id, status: print(f'Batch {batch_id}: {status}', flush=True)
+    failures = run_message_batch_transform(get_client(), args.platform, args.csv, output, on_status)
+    for failure in failures:
+        print(f"Rows {failure['first_row']}-{failure['last_row']} failed: {failure['error']}")
+    print(f'Wrote {output}')
+    return 1 if failures else 0
+
+
+def worker_cli(argv):
+    """python app.py worker [--processes N]"""
+    import argparse
+    import multiprocessing
+    parser = argparse.ArgumentParser(prog='app.py worker', description='Run spans queued in NASHA_QUEUE_DB')
+    parser.add_argument('--processes', type=int, default=1, help='Processes to run, each with NASHA_QUEUE_WORKERS threads')
+    args = parser.parse_args(argv)
+
+    if not QUEUE_PATH:
+        print('NASHA_QUEUE_DB is not set')
+        return 1
+    for _ in range(args.processes - 1):
+        multiprocessing.get_context('spawn').Process(target=serve_span_workers, daemon=True).start()
+    serve_span_workers()
+
+
+# Every process using the span queue lends its span workers to every pipeline
+start_span_workers()
+
 
 if __name__ == '__main__':
+    import sys
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ['worker']:
+        sys.exit(worker_cli(sys.argv[2:]))
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
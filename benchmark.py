@@ -0,0 +1,356 @@
+"""
+Nasha Smart CSV Transformer - Benchmarks
+Measures the app's own overhead (CSV parsing, rule engine, prompt building,
+response parsing, column ordering, CSV writing and whole requests) against a
+fake Anthropic client, so model latency doesn't hide regressions.
+
+    python benchmark.py --rows 100,1000,10000 --output bench.json
+    python benchmark.py --rows 100,1000,10000 --compare bench.json
+
+Each stage runs in a fresh process so its peak RSS is its own. Results are
+written as JSON tagged with the git commit; --compare flags stages whose
+throughput or p95 latency regressed beyond --threshold.
+"""
+
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+STAGES = [
+    'csv_parse', 'rule_engine', 'prompt_build', 'response_parse',
+    'column_order', 'csv_write', 'analyze_request', 'transform_request',
+]
+
+STRAIN_WORDS = [
+    'Acai', 'Mints', 'Banana', 'OG', 'GMO', 'Jelly', 'Donutz', 'Moroccan', 'Peaches',
+    'Lemon', 'Cherry', 'Runtz', 'Gelato', 'Zkittlez', 'Papaya', 'Guava', 'Kush', 'Haze',
+]
+
+# One product name template per PRODUCT_TAXONOMY subcategory
+NAME_TEMPLATES = {
+    'Green Unpressed Hash': '{strain} Green Unpressed Hash 1g ({genetics})',
+    'Orange Unpressed Hash': '{strain} Orange Unpressed Hash 1g ({genetics})',
+    'Red Pressed Hash': '{strain} Red Pressed Hash 1g ({genetics})',
+    'Blue Pressed Hash': '{strain} Blue Pressed Hash 1g ({genetics})',
+    'Onyx Live Pressed Hash': '{strain} Onyx Live Pressed Hash 1g ({genetics})',
+    'Cold Cure Live Rosin': '{strain} Cold Cure Live Rosin 1g ({genetics})',
+    '3.5g': '{strain} Flower 3.5g ({genetics})',
+    '7g': '{strain} Flower 7g ({genetics})',
+    '14g': '{strain} Flower 14g ({genetics})',
+    '0.5g All-In-One': '{strain} Live Rosin All-In-One Vape 0.5g ({genetics})',
+    '1g All-In-One': '{strain} Live Rosin All-In-One Vape 1g ({genetics})',
+    '510 Vape Cart': '{strain} 510 Vape Cart 1g ({genetics})',
+    'Altitude Infused Hash Prerolls': 'Altitude {strain} Infused Hash Preroll 1g ({genetics})',
+    'Submerge Infused Hash Prerolls': 'Submerge {strain} Infused Hash Preroll 1g ({genetics})',
+    'Live Rosin Infused Prerolls': '{strain} Live Rosin Infused Preroll 1g ({genetics})',
+    '5 Pack Hash-Infused Multipack': '{strain} 5 Pack Hash-Infused Prerolls ({genetics})',
+    '5 Pack Live Rosin-Infused Multipack': '{strain} 5 Pack Live Rosin-Infused Prerolls ({genetics})',
+}
+
+CATALOG_COLUMNS = ['Product Name', 'Description', 'Photo', 'Batch', 'SKU']
+
+
+def synthetic_catalog(rows, model_share=0.3, seed=0):
+    """CSV bytes of a catalog cycling through every taxonomy subcategory.
+
+    About model_share of the rows carry a description label the rule engine
+    doesn't know, so they take the model path.
+    """
+    rng = random.Random(seed)
+    subcategories = list(NAME_TEMPLATES)
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=CATALOG_COLUMNS)
+    writer.writeheader()
+    for i in range(rows):
+        strain = f'{rng.choice(STRAIN_WORDS)} {rng.choice(STRAIN_WORDS)} #{i}'
+        name = NAME_TEMPLATES[subcategories[i % len(subcategories)]].format(
+            strain=strain, genetics=rng.choice('SIH')
+        )
+        lines = [
+            f'THC: {rng.randint(20, 90)}%',
+            f'LINEAGE: {rng.choice(STRAIN_WORDS)} x {rng.choice(STRAIN_WORDS)}',
+            f'TASTE: {rng.choice(STRAIN_WORDS).lower()}, citrus, pine',
+            'FEELING: Relaxed, focused, happy',
+            f'FARM: {rng.choice(STRAIN_WORDS)} Valley Farms',
+            'PLACE GROWN: Humboldt, CA',
+        ]
+        if rng.random() < model_share:
+            lines.append('NOTES: Small batch, hand washed')
+        marketing = f'{strain} is a small-batch cultivar. ' * rng.randint(2, 6)
+        writer.writerow({
+            'Product Name': name,
+            'Description': '\n'.join(lines) + '\n\n' + marketing.strip(),
+            'Photo': f'https://example.com/photos/{i}.jpg',
+            'Batch': f'B{i:06d}',
+            'SKU': f'NASHA-{i:06d}',
+        })
+    return output.getvalue().encode('utf-8')
+
+
+def canned_rows(system_text, batch):
+    """Canned model output objects for a batch, shaped like the real responses"""
+    if 'main_category' in system_text:
+        return [{'main_category': 'Hash', 'subcategory': 'Green Unpressed Hash', 'type': 'Sativa'}
+                for _ in batch]
+    if 'RECORD FIELDS' in system_text:
+        return [{'name': row.get('Product Name', ''), 'strain': 'Strain', 'category': 'hash',
+                 'marketing': row.get('Description', '')} for row in batch]
+    platform = system_text.split('Transform products to ', 1)[1].split(' format', 1)[0]
+    import app
+    return [{col: (row.get('Description', '') if 'escription' in col else 'x')
+             for col in app.PLATFORM_COLUMNS[platform]} for row in batch]
+
+
+class FakeMessage:
+    """Finished message with the fields the app reads"""
+
+    def __init__(self, model, text, input_tokens, output_tokens):
+        self.model = model
+        self.content = [types.SimpleNamespace(type='text', text=text)]
+        self.stop_reason = 'end_turn'
+        self.usage = types.SimpleNamespace(
+            input_tokens=input_tokens, output_tokens=output_tokens,
+            cache_creation_input_tokens=0, cache_read_input_tokens=input_tokens,
+        )
+
+
+class FakeStream:
+    """Context manager and stream in one, like anthropic's MessageStreamManager"""
+
+    def __init__(self, message, latency, chunk_size):
+        self.message = message
+        self.latency = latency
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        # Time to first token
+        time.sleep(self.latency)
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        text = self.message.content[0].text
+        for start in range(0, len(text), self.chunk_size):
+            yield text[start:start + self.chunk_size]
+
+    def get_final_message(self):
+        return self.message
+
+
+class FakeMessages:
+    def __init__(self, latency, chunk_size, canned):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.canned = canned
+        self.calls = 0
+
+    def _message(self, kwargs):
+        self.calls += 1
+        system = kwargs['system']
+        system_text = system[0]['text'] if isinstance(system, list) else system
+        content = kwargs['messages'][0]['content']
+        batch = json.loads(content[content.index('['):])
+        text = json.dumps(self.canned(system_text, batch))
+        return FakeMessage(kwargs['model'], text, len(content) // 4, len(text) // 4)
+
+    def stream(self, **kwargs):
+        return FakeStream(self._message(kwargs), self.latency, self.chunk_size)
+
+    def create(self, **kwargs):
+        time.sleep(self.latency)
+        return self._message(kwargs)
+
+
+class FakeAnthropic:
+    """Stand-in for anthropic.Anthropic with a fixed per-call latency and canned JSON"""
+
+    def __init__(self, latency=0.0, chunk_size=64, canned=canned_rows):
+        self.messages = FakeMessages(latency, chunk_size, canned)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timed(items, func):
+    """Run func over items, returning per-item latencies in seconds"""
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_stage(stage, rows, options):
+    """Run one stage in this process; returns (per-item latencies, total seconds)"""
+    import app
+
+    data = synthetic_catalog(rows, options['model_share'])
+    platform = options['platform']
+    parsed = list(app.iter_upload_rows(io.BytesIO(data)))
+    batches = [parsed[i:i + 10] for i in range(0, len(parsed), 10)]
+    start = time.perf_counter()
+
+    if stage == 'csv_parse':
+        stream = app.iter_upload_rows(io.BytesIO(data))
+        start = time.perf_counter()
+        latencies = timed(range(rows), lambda _: next(stream))
+    elif stage == 'rule_engine':
+        latencies = timed(parsed, lambda row: app.rule_transform(platform, row))
+    elif stage == 'prompt_build':
+        latencies = timed(batches, lambda batch: app.build_transform_message(batch, platform))
+    elif stage == 'response_parse':
+        system = app.TRANSFORM_INSTRUCTIONS[platform]
+        responses = [json.dumps(canned_rows(system, batch)) for batch in batches]
+        start = time.perf_counter()
+        latencies = timed(responses, lambda text: app.JsonArrayParser().feed(text))
+    elif stage == 'column_order':
+        outputs = canned_rows(app.TRANSFORM_INSTRUCTIONS[platform], parsed)
+        start = time.perf_counter()
+        latencies = timed(outputs, lambda row: app.check_platform_row(platform, row))
+    elif stage == 'csv_write':
+        outputs = [app.pad_platform_row(platform, row)
+                   for row in canned_rows(app.TRANSFORM_INSTRUCTIONS[platform], parsed)]
+        writer = csv.writer(io.StringIO())
+        start = time.perf_counter()
+        latencies = timed(outputs, writer.writerow)
+    else:
+        app._client = FakeAnthropic(options['latency'], options['chunk_size'])
+        test_client = app.app.test_client()
+        if stage == 'analyze_request':
+            request = lambda _: test_client.post(
+                '/analyze', data={'file': (io.BytesIO(data), 'catalog.csv')}
+            ).get_json()
+        else:
+            request = lambda _: test_client.post(
+                '/transform', data={'file': (io.BytesIO(data), 'catalog.csv'), 'platform': platform}
+            ).get_data()
+        start = time.perf_counter()
+        latencies = timed(range(options['repeat']), request)
+
+    return latencies, time.perf_counter() - start
+
+
+def stage_worker(stage, rows, options, results):
+    # Isolate the app from any local cache, checkpoints or job state
+    os.environ['NASHA_CACHE_PATH'] = ''
+    os.environ['NASHA_CHECKPOINT_PATH'] = ''
+    os.environ['NASHA_JOB_DIR'] = tempfile.mkdtemp(prefix='nasha-bench-')
+    os.environ['ANTHROPIC_API_KEY'] = 'benchmark'
+    import app  # noqa: F401 - baseline RSS includes the app and its imports
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies, seconds = run_stage(stage, rows, options)
+    # Request stages process the whole catalog once per repeat
+    processed = rows * options['repeat'] if stage.endswith('_request') else rows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    results.put({
+        'stage': stage,
+        'rows': rows,
+        'seconds': round(seconds, 6),
+        'rows_per_sec': round(processed / seconds, 1) if seconds else None,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 4),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 4),
+        'peak_rss_mb': round(peak / scale, 1),
+        'stage_rss_mb': round((peak - baseline) / scale, 1),
+    })
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print throughput/p95 changes against a previous run; returns the regressions"""
+    previous = {(r['stage'], r['rows']): r for r in baseline['results']}
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for result in results:
+        before = previous.get((result['stage'], result['rows']))
+        if not before or not before['rows_per_sec'] or not result['rows_per_sec']:
+            continue
+        throughput = result['rows_per_sec'] / before['rows_per_sec'] - 1
+        p95 = result['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0.0
+        regressed = throughput < -threshold or p95 > threshold
+        if regressed:
+            regressions.append(result)
+        print(f"{result['stage']:<18} {result['rows']:>7}  rows/s {throughput:+7.1%}  p95 {p95:+7.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='100,1000,10000',
+                        help='Comma-separated catalog sizes (default: 100,1000,10000; up to 100000)')
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma-separated stages to run')
+    parser.add_argument('--platform', default='squarespace', help='Platform for transform stages')
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake model latency per call (seconds)')
+    parser.add_argument('--chunk-size', type=int, default=64, help='Characters per streamed text chunk')
+    parser.add_argument('--model-share', type=float, default=0.3,
+                        help='Share of rows the rule engine can\'t parse, sent to the fake model')
+    parser.add_argument('--repeat', type=int, default=3, help='Requests per size for request stages')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Previous results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change counted as a regression (default: 0.1)')
+    args = parser.parse_args(argv)
+
+    options = {
+        'platform': args.platform, 'latency': args.latency, 'chunk_size': args.chunk_size,
+        'model_share': args.model_share, 'repeat': args.repeat,
+    }
+    context = multiprocessing.get_context('spawn')
+    results = []
+    print(f"{'stage':<18} {'rows':>7} {'rows/s':>12} {'p50 ms':>10} {'p95 ms':>10} {'peak MB':>8} {'stage MB':>8}")
+    for rows in [int(r) for r in args.rows.split(',')]:
+        for stage in args.stages.split(','):
+            queue = context.Queue()
+            process = context.Process(target=stage_worker, args=(stage, rows, options, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            results.append(result)
+            print(f"{stage:<18} {rows:>7} {result['rows_per_sec']:>12} {result['p50_ms']:>10} "
+                  f"{result['p95_ms']:>10} {result['peak_rss_mb']:>8} {result['stage_rss_mb']:>8}")
+
+    report = {'commit': git_commit(), 'python': sys.version.split()[0], 'options': options, 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('options') != options:
+            print('\nNote: baseline was run with different options', baseline.get('options'))
+        return 1 if compare(results, baseline, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import csv
+import io
+import os
+import sys
+
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test')
+os.environ['NASHA_CACHE_PATH'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import benchmark  # noqa: E402
+
+
+def run_delta(rows, mode='full', model_share=0.3):
+    upload = list(csv.DictReader(io.StringIO(benchmark.synthetic_catalog(rows, model_share).decode('utf-8'))))
+    with app.app.test_request_context():
+        body = ''.join(app.iter_delta_csv(benchmark.FakeAnthropic(), 'leafly', upload, 'test', mode))
+    names = [row['Product Name'] for row in upload]
+    return names, list(csv.DictReader(io.StringIO(body)))
+
+
+def test_delta_spans_more_than_one_dispatch_window(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'catalog_store', app.CatalogStore(str(tmp_path / 'catalog.sqlite3')))
+    # Small batches, so early spans are written while later rows are still being diffed
+    monkeypatch.setattr(app, 'BATCH_MAX_ROWS', 2)
+    names, out = run_delta(300)
+    assert len(out) == len(names)
+
+    names, out = run_delta(300, mode='changes')
+    assert out == []
+
+
+def test_delta_all_local_catalog(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'catalog_store', app.CatalogStore(str(tmp_path / 'catalog.sqlite3')))
+    names, out = run_delta(3000, model_share=0)
+    assert [row['Name'] for row in out] == names
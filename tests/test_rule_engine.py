@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test')
+os.environ['NASHA_CACHE_PATH'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+DESCRIPTION = '\n'.join([
+    'THC: 31%', 'LINEAGE: Afghani x Thai', 'TASTE: Earthy, sweet', 'FEELING: Relaxed',
+    'FARM: Sun Valley Farms', 'PLACE GROWN: Humboldt, CA', '', 'A small-batch cultivar.',
+])
+
+
+def parse(name):
+    return app.parse_product({'Product Name': name, 'Description': DESCRIPTION})
+
+
+@pytest.mark.parametrize('name', [
+    'Hash Plant Flower 3.5g (I)',
+    'Flower of Life Flower 7g (S)',
+    'Cart Blanche 510 Cart 1g (H)',
+    'Blue Dream Hash 1g (H)',
+])
+def test_ambiguous_names_go_to_the_model(name):
+    assert parse(name) is None
+
+
+@pytest.mark.parametrize('name, category, strain', [
+    ('Blue Dream Flower 3.5g (S)', 'flower', 'Blue Dream'),
+    ('Blue Dream Green Unpressed Hash 1g (H)', 'hash', 'Blue Dream'),
+    ('Altitude Blue Dream Infused Hash Preroll 1g (S)', 'preroll-infused', 'Blue Dream'),
+    ('Blue Dream Live Rosin All-In-One Vape 1g (H)', 'vape-aio', 'Blue Dream'),
+])
+def test_clear_names_parse_locally(name, category, strain):
+    record = parse(name)
+    assert (record['category'], record['strain']) == (category, strain)
+
+
+def test_conflicting_cues_lower_classifier_confidence():
+    analysis, confidence = app.classify_product({'Product Name': 'Cart Blanche Flower 3.5g (S)'})
+    assert confidence < app.CLASSIFIER_MIN_CONFIDENCE